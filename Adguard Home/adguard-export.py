@@ -0,0 +1,265 @@
+#!/usr/bin/python3
+
+#
+# Exports querylog into one Parquet file per day, with hostnames, clients, query types and rules dictionary encoded,
+# and runs the reports from common-sql-queries-on-adguard-dns-query-data.md against those files so the heavy scans
+# don't have to run on the MariaDB instance the downloader writes to.
+#
+#   ./adguard-export.py export                 bring the files up to date, run it from cron or a timer
+#   ./adguard-export.py report top-blocked     run a report against the files
+#
+# Needs pyarrow (python3-pyarrow). The database settings are read from adguard-log-downloader.py in the same directory.
+#
+
+import argparse
+import datetime
+import json
+import os
+import shutil
+import sys
+import time
+
+from adguard_common import load_downloader
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.dataset
+    import pyarrow.parquet
+except ImportError:
+    sys.exit("adguard-export.py needs pyarrow, install python3-pyarrow or pip install pyarrow")
+
+# Config Section
+
+# Where the Parquet files go, one directory per day named date=YYYY-MM-DD
+EXPORT_DIR = "/var/lib/adguard-log-downloader/export"
+
+# Days before the newest exported one that are exported again on every run, to pick up rows that arrive late from
+# the spool or a busy router. Use --since after a backfill that goes back further
+EXPORT_REOPEN_DAYS = 2
+
+# Rows fetched from MariaDB and written to Parquet at a time
+EXPORT_BATCH_SIZE = 50000
+
+# Nothing is configurable below this line
+
+REPORTS = {
+    "top-blocked": ("hostname", True, "Blocked hostnames by number of queries"),
+    "top-hostnames": ("hostname", None, "Hostnames by number of queries"),
+    "top-clients": ("client", None, "Clients by number of queries"),
+    "qtypes": ("qtype", None, "Queries by query type"),
+    "filter-lists": ("ruleid", True, "Blocked queries by filter list id")
+}
+
+downloader = load_downloader()
+
+def get_schema():
+    text = pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+    fields = [
+        ("time", pyarrow.timestamp("us")),
+        ("hostname", text),
+        ("client", text),
+        ("qtype", text),
+        ("blocked", pyarrow.bool_()),
+        ("rule", text),
+        ("ruleid", pyarrow.uint16())
+    ]
+
+    if downloader.DB_SOURCES:
+        fields.append(("source", text))
+
+    return pyarrow.schema(fields)
+
+def get_partitioning():
+    return pyarrow.dataset.partitioning(pyarrow.schema([("date", pyarrow.string())]), flavor="hive")
+
+def read_manifest(export_dir):
+    try:
+        with open(os.path.join(export_dir, "export.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_manifest(export_dir, manifest):
+    tmp = os.path.join(export_dir, "export.json.tmp")
+    with open(tmp, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp, os.path.join(export_dir, "export.json"))
+
+def to_batch(schema, rows):
+    columns = list(zip(*rows))
+    arrays = []
+
+    for field, values in zip(schema, columns):
+        if pyarrow.types.is_dictionary(field.type):
+            arrays.append(pyarrow.array(values, pyarrow.string()).dictionary_encode())
+        elif pyarrow.types.is_boolean(field.type):
+            arrays.append(pyarrow.array([bool(value) if value is not None else None for value in values], field.type))
+        else:
+            arrays.append(pyarrow.array(values, field.type))
+
+    return pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+
+# Stream one day of querylog into date=YYYY-MM-DD/part.parquet, written next to the old file and renamed over it so
+# reports never see half a day. Returns the number of rows
+def export_day(db, export_dir, schema, day):
+    import pymysql.cursors
+
+    source = "querylog_expanded" if downloader.DB_SCHEMA == "normalized" else "querylog"
+    day_dir = os.path.join(export_dir, f"date={day.isoformat()}")
+    tmp = os.path.join(export_dir, f".{day.isoformat()}.parquet.tmp")
+    start = datetime.datetime.combine(day, datetime.time())
+
+    rows = 0
+    writer = None
+
+    with db.cursor(pymysql.cursors.SSCursor) as c:
+        c.execute(f"""
+            SELECT `time`, hostname, client, qtype, blocked, rule, ruleid{", source" if downloader.DB_SOURCES else ""}
+            FROM `{source}`
+            WHERE `time` >= %s AND `time` < %s
+            ORDER BY `time`
+        """, (start, start + datetime.timedelta(days=1)))
+
+        while True:
+            batch = c.fetchmany(EXPORT_BATCH_SIZE)
+            if not batch:
+                break
+
+            if writer is None:
+                writer = pyarrow.parquet.ParquetWriter(tmp, schema, compression="zstd")
+
+            writer.write_batch(to_batch(schema, batch))
+            rows += len(batch)
+
+    if writer is None:
+        shutil.rmtree(day_dir, ignore_errors=True)
+        return 0
+
+    writer.close()
+    os.makedirs(day_dir, exist_ok=True)
+    os.replace(tmp, os.path.join(day_dir, "part.parquet"))
+
+    return rows
+
+# Export every day from the reopened days (or since, or the first day in querylog) up to today
+def export(export_dir, since):
+    os.makedirs(export_dir, exist_ok=True)
+    manifest = read_manifest(export_dir)
+    schema = get_schema()
+
+    db = downloader.db_connect()
+
+    try:
+        if since is not None:
+            first = since
+        elif manifest.get("last_day"):
+            first = datetime.date.fromisoformat(manifest["last_day"]) - datetime.timedelta(days=EXPORT_REOPEN_DAYS)
+        else:
+            with db.cursor() as c:
+                c.execute("SELECT MIN(`time`) FROM querylog")
+                oldest = c.fetchone()[0]
+
+            if oldest is None:
+                print("querylog is empty")
+                return
+            first = oldest.date()
+
+        today = datetime.date.today()
+        day = first
+        total_rows = 0
+        started = time.monotonic()
+
+        while day <= today:
+            rows = export_day(db, export_dir, schema, day)
+            total_rows += rows
+            print(f"{day.isoformat()}: {rows} rows")
+
+            manifest["last_day"] = day.isoformat()
+            write_manifest(export_dir, manifest)
+
+            day += datetime.timedelta(days=1)
+    finally:
+        db.close()
+
+    elapsed = time.monotonic() - started
+    print(f"Exported {total_rows} rows in {elapsed:.2f}s ({total_rows / max(elapsed, 1e-6):.0f} rows/s)")
+
+# The rows in the export between since and until, only the days in that range are read
+def load_table(export_dir, columns, since, until):
+    dataset = pyarrow.dataset.dataset(export_dir, format="parquet", partitioning=get_partitioning(), exclude_invalid_files=True)
+    field = pyarrow.dataset.field
+    condition = None
+
+    if since is not None:
+        condition = (field("date") >= since.date().isoformat()) & (field("time") >= pyarrow.scalar(since, pyarrow.timestamp("us")))
+
+    if until is not None:
+        # The day until falls on can still hold rows before it
+        part = (field("date") <= until.date().isoformat()) & (field("time") < pyarrow.scalar(until, pyarrow.timestamp("us")))
+        condition = part if condition is None else condition & part
+
+    return dataset.to_table(columns=columns, filter=condition)
+
+def report_span(export_dir, since, until):
+    table = load_table(export_dir, ["time"], since, until)
+
+    if table.num_rows == 0:
+        print("No data")
+        return
+
+    span = pyarrow.compute.min_max(table["time"])
+    first, last = span["min"].as_py(), span["max"].as_py()
+
+    diff = int((last - first).total_seconds())
+    print(f"{first} - {last}: {diff // 86400} days, {diff % 86400 // 3600} hours, {diff % 3600 // 60} minutes, {diff % 60} seconds")
+
+def report_top(export_dir, name, since, until, limit):
+    column, blocked, title = REPORTS[name]
+    table = load_table(export_dir, [column, "blocked"], since, until)
+
+    if blocked is not None:
+        table = table.filter(pyarrow.compute.equal(table["blocked"], blocked))
+
+    # Every file has its own dictionaries, they have to be merged before grouping on them
+    counts = table.select([column]).unify_dictionaries().group_by(column).aggregate([([], "count_all")])
+    counts = counts.sort_by([("count_all", "descending")]).slice(0, limit)
+
+    print(title)
+    for value, total in zip(counts[column].to_pylist(), counts["count_all"].to_pylist()):
+        print(f"{total:>12}  {value}")
+
+def parse_time_arg(value):
+    return datetime.datetime.fromisoformat(value)
+
+def main():
+    argparser = argparse.ArgumentParser(description="Export the AdGuard Home query log to Parquet and run reports on it.")
+    argparser.add_argument("--dir", default=EXPORT_DIR, help="Directory the Parquet files are in")
+    subparsers = argparser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="Bring the Parquet files up to date with querylog")
+    export_parser.add_argument("--since", type=datetime.date.fromisoformat, default=None, help="Export every day from this one on again, eg after a backfill")
+
+    report_parser = subparsers.add_parser("report", help="Run a report against the Parquet files")
+    report_parser.add_argument("report", choices=["span"] + list(REPORTS))
+    report_parser.add_argument("--since", type=parse_time_arg, default=None, help="Only include data from this local time on, eg 2025-01-01 or 2025-01-01T12:30")
+    report_parser.add_argument("--until", type=parse_time_arg, default=None, help="Only include data before this local time")
+    report_parser.add_argument("-n", "--limit", type=int, default=25, help="Number of rows to show")
+
+    args = argparser.parse_args()
+
+    if args.command == "export":
+        export(args.dir, args.since)
+        return
+
+    started = time.monotonic()
+
+    if args.report == "span":
+        report_span(args.dir, args.since, args.until)
+    else:
+        report_top(args.dir, args.report, args.since, args.until, args.limit)
+
+    print(f"({(time.monotonic() - started) * 1000:.1f} ms)", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
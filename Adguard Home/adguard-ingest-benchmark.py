@@ -0,0 +1,456 @@
+#!/usr/bin/python3
+
+#
+# Benchmarks adguard-log-downloader.py end to end against a stand-in AdGuard Home: a local HTTP server with the same
+# /control/querylog paging (limit, older_than, response_status) serving a synthetic query log with Zipf distributed
+# hostnames and clients, blocked and allowlisted queries and CNAME chains. The downloader settings come from
+# adguard-log-downloader.py, only the URL and the database are swapped.
+#
+#   ./adguard-ingest-benchmark.py                           SQLite in a temporary directory
+#   ./adguard-ingest-benchmark.py --target mariadb --database adguard_bench
+#
+# The MariaDB database has to be a scratch copy made with adguard-log-downloader.sql (and whichever of the other .sql
+# files match the settings), querylog and the watermarks in it are cleared first. Each run does a first poll of the
+# whole log and then an incremental poll after more entries are appended, and reports rows per second, pages, DB
+# calls and peak memory for both.
+#
+
+import argparse
+import bisect
+import datetime
+import json
+import os
+import random
+import re
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+from adguard_common import load_downloader
+
+# Nothing is configurable below this line
+
+script = os.path.abspath(__file__)
+
+QTYPES = (("A", 55), ("AAAA", 30), ("HTTPS", 10), ("PTR", 2), ("TXT", 2), ("MX", 1))
+
+# Synthetic query log, newest entry first like AdGuard Home returns it. Each entry is kept JSON encoded so pages
+# are just joined together
+class QueryLog:
+    def __init__(self, seed, hostnames, clients, qps, block_rate):
+        self.rng = random.Random(seed)
+        self.qps = qps
+        self.block_rate = block_rate
+        self.hostnames = [f"{self.word()}.{self.word()}.{self.rng.choice(['com', 'net', 'org', 'io', 'com.au'])}" for _ in range(hostnames)]
+        self.hostname_weights = self.zipf(hostnames, 1.1)
+        self.clients = [f"192.168.1.{i + 2}" if i < 200 else f"fd00::{i:x}" for i in range(clients)]
+        self.client_weights = self.zipf(clients, 0.8)
+        self.qtypes = [q for q, w in QTYPES]
+        self.qtype_weights = [w for q, w in QTYPES]
+
+        self.encoded = []
+        self.times = []
+        self.blocked = []
+        self.lock = threading.Lock()
+
+    def word(self):
+        return "".join(self.rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(self.rng.randint(3, 10)))
+
+    @staticmethod
+    def zipf(n, s):
+        total = 0
+        weights = []
+        for i in range(n):
+            total += 1 / (i + 1) ** s
+            weights.append(total)
+        return weights
+
+    def answers(self, hostname, qtype):
+        rng = self.rng
+        answers = []
+
+        if rng.random() < 0.3:
+            for depth in range(rng.randint(1, 3)):
+                answers.append({"type": "CNAME", "value": f"{self.word()}.cdn.example.net.", "ttl": rng.randint(30, 3600)})
+
+        if qtype == "A":
+            answers += [{"type": "A", "value": f"203.0.113.{rng.randrange(256)}", "ttl": rng.randint(30, 600)} for _ in range(rng.randint(1, 4))]
+        elif qtype == "AAAA":
+            answers += [{"type": "AAAA", "value": f"2001:db8::{rng.randrange(65536):x}", "ttl": rng.randint(30, 600)} for _ in range(rng.randint(1, 2))]
+        elif qtype == "HTTPS":
+            answers.append({"type": "HTTPS", "value": f"1 . alpn=h3,h2 ipv4hint=203.0.113.{rng.randrange(256)}", "ttl": 300})
+        elif qtype == "PTR":
+            answers.append({"type": "PTR", "value": f"{self.word()}.lan.", "ttl": 60})
+        elif qtype == "TXT":
+            answers.append({"type": "TXT", "value": "v=spf1 " + " ".join(f"include:{self.word()}.example" for _ in range(rng.randint(1, 6))) + " -all", "ttl": 3600})
+        else:
+            answers.append({"type": "MX", "value": f"10 mail.{hostname}.", "ttl": 3600})
+
+        return answers
+
+    def entry(self, dt):
+        rng = self.rng
+        hostname = rng.choices(self.hostnames, cum_weights=self.hostname_weights)[0]
+        qtype = rng.choices(self.qtypes, weights=self.qtype_weights)[0]
+        roll = rng.random()
+
+        e = {
+            "cached": rng.random() < 0.4,
+            "client": rng.choices(self.clients, cum_weights=self.client_weights)[0],
+            "client_info": {"whois": {}, "name": "", "disallowed_rule": "", "disallowed": False},
+            "client_proto": "",
+            "elapsedMs": f"{rng.expovariate(1 / 15):.6f}",
+            "question": {"class": "IN", "name": hostname, "type": qtype},
+            "status": "NOERROR",
+            # Microseconds padded out to the nanoseconds AdGuard Home writes
+            "time": dt.isoformat(timespec="microseconds")[:26] + f"{rng.randrange(1000):03d}" + dt.isoformat()[-6:],
+            "upstream": "https://dns.example/dns-query"
+        }
+
+        if roll < self.block_rate:
+            rule = f"||{hostname}^"
+            e.update(answer=[{"type": qtype if qtype in ("A", "AAAA") else "A", "value": "0.0.0.0" if qtype != "AAAA" else "::", "ttl": 10}],
+                     reason="FilteredBlackList", rule=rule, rules=[{"filter_list_id": rng.choice([1, 2, 3, 1700000000]), "text": rule}])
+            return e, True
+
+        if roll < self.block_rate + 0.01:
+            rule = f"@@||{hostname}^"
+            e.update(reason="NotFilteredWhiteList", rule=rule, rules=[{"filter_list_id": 0, "text": rule}])
+        else:
+            e["reason"] = "NotFilteredNotFound"
+
+        if rng.random() < 0.05:
+            e["status"] = "NXDOMAIN"
+        else:
+            e["answer"] = self.answers(hostname, qtype)
+
+        return e, False
+
+    # Add n entries newer than everything so far. The first ones end at now, later ones carry on from the newest entry
+    def append(self, n):
+        gaps = [self.rng.expovariate(self.qps) for _ in range(n)]
+
+        with self.lock:
+            if self.times:
+                dt = datetime.datetime.fromtimestamp(-self.times[0]).astimezone()
+            else:
+                dt = datetime.datetime.now().astimezone() - datetime.timedelta(seconds=sum(gaps))
+
+            entries = []
+            for gap in gaps:
+                dt += datetime.timedelta(seconds=gap)
+                entries.append(self.entry(dt))
+            entries.reverse()
+
+            self.encoded[0:0] = [json.dumps(e).encode() for e, blocked in entries]
+            self.blocked[0:0] = [blocked for e, blocked in entries]
+            # Kept negated so the newest first list is ascending for bisect
+            self.times[0:0] = [-QueryLog.timestamp(e["time"]) for e, blocked in entries]
+
+    @staticmethod
+    def timestamp(ts):
+        return datetime.datetime.fromisoformat(ts[:26] + ts[29:]).timestamp()
+
+    def page(self, limit, older_than, status):
+        with self.lock:
+            start = bisect.bisect_right(self.times, -QueryLog.timestamp(older_than)) if older_than else 0
+
+            if status in ("filtered", "blocked"):
+                picked = [i for i in range(start, len(self.encoded)) if self.blocked[i]][:limit]
+            else:
+                picked = range(start, min(start + limit, len(self.encoded)))
+
+            data = [self.encoded[i] for i in picked]
+
+        oldest = json.loads(data[-1])["time"] if data else ""
+        return b'{"data":[' + b",".join(data) + b'],"oldest":' + json.dumps(oldest).encode() + b"}"
+
+# Stand-in AdGuard Home, runs in its own process so serving pages doesn't compete with the downloader for the GIL.
+# POST /bench/append?n= adds entries, the first line on stdout is the port
+def serve(args):
+    import http.server
+
+    log = QueryLog(args.seed, args.hostnames, args.clients, args.qps, args.block_rate)
+    log.append(args.entries)
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def reply(self, body, content_type="application/json"):
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            if url.path != "/control/querylog":
+                self.send_error(404)
+                return
+
+            query = urllib.parse.parse_qs(url.query)
+            limit = int(query.get("limit", ["500"])[0])
+            older_than = query.get("older_than", [""])[0]
+            status = query.get("response_status", ["all"])[0]
+
+            self.reply(log.page(limit, older_than, status))
+
+        def do_POST(self):
+            url = urllib.parse.urlsplit(self.path)
+            if url.path != "/bench/append":
+                self.send_error(404)
+                return
+
+            log.append(int(urllib.parse.parse_qs(url.query).get("n", ["1000"])[0]))
+            self.reply(json.dumps({"entries": len(log.encoded)}).encode())
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    print(server.server_address[1], flush=True)
+    server.serve_forever()
+
+# Enough of a pymysql connection on top of sqlite3 for the downloader's legacy schema without rollups or partitions
+class SqliteConnection:
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=30)
+
+    @staticmethod
+    def translate(query):
+        query = query.replace("%s", "?").replace("INSERT IGNORE", "INSERT OR IGNORE")
+        return re.sub(r"ON DUPLICATE KEY UPDATE v = VALUES\(v\)", "ON CONFLICT(k) DO UPDATE SET v = excluded.v", query)
+
+    def cursor(self, *args):
+        return SqliteCursor(self.conn.cursor())
+
+    def begin(self):
+        self.conn.execute("BEGIN")
+
+    def commit(self):
+        self.conn.execute("COMMIT")
+
+    def rollback(self):
+        if self.conn.in_transaction:
+            self.conn.execute("ROLLBACK")
+
+    def ping(self, reconnect=False):
+        pass
+
+    def close(self):
+        self.conn.close()
+
+class SqliteCursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cursor.close()
+
+    def execute(self, query, args=None):
+        self.cursor.execute(SqliteConnection.translate(query), args or ())
+        return self.cursor.rowcount
+
+    def executemany(self, query, args):
+        self.cursor.executemany(SqliteConnection.translate(query), args)
+        return self.cursor.rowcount
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+def create_sqlite(path):
+    sqlite3.register_adapter(datetime.datetime, lambda dt: dt.isoformat(" "))
+
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        PRAGMA journal_mode = WAL;
+        CREATE TABLE querylog (
+          id INTEGER PRIMARY KEY,
+          time TEXT NOT NULL,
+          hostname TEXT, client TEXT, qtype TEXT, answers TEXT, blocked INTEGER, rule TEXT, ruleid INTEGER,
+          UNIQUE (time, hostname, client, qtype)
+        );
+        CREATE TABLE state (k TEXT PRIMARY KEY, v TEXT);
+    """)
+    conn.close()
+
+# Counts every call that goes to the database, begin, commit and ping included. pymysql's executemany() is counted
+# once although it can split very large batches
+db_calls = 0
+db_calls_lock = threading.Lock()
+
+def count_call():
+    global db_calls
+    with db_calls_lock:
+        db_calls += 1
+
+class CountingConnection:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def cursor(self, *args):
+        return CountingCursor(self.conn.cursor(*args))
+
+    def begin(self):
+        count_call()
+        self.conn.begin()
+
+    def commit(self):
+        count_call()
+        self.conn.commit()
+
+    def rollback(self):
+        count_call()
+        self.conn.rollback()
+
+    def ping(self, reconnect=False):
+        count_call()
+        self.conn.ping(reconnect=reconnect)
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+class CountingCursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __enter__(self):
+        self.cursor.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self.cursor.__exit__(*exc)
+
+    def execute(self, query, args=None):
+        count_call()
+        return self.cursor.execute(query, args)
+
+    def executemany(self, query, args):
+        count_call()
+        return self.cursor.executemany(query, args)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+def run_poll(downloader, name):
+    global db_calls
+
+    inserted_before = sum(value for (metric, labels), value in downloader.metrics.items() if metric == "adguard_rows_inserted_total")
+    with db_calls_lock:
+        db_calls = 0
+
+    started = time.monotonic()
+    status = downloader.poll_all(downloader.load_instances())
+    elapsed = time.monotonic() - started
+
+    if status:
+        sys.exit(f"{name}: poll failed")
+
+    stats = downloader.fetch_stats[""]
+    inserted = sum(value for (metric, labels), value in downloader.metrics.items() if metric == "adguard_rows_inserted_total") - inserted_before
+
+    print(f"{name:<12} {inserted:>9} rows in {elapsed:7.2f}s  {inserted / max(elapsed, 1e-6):>9,.0f} rows/s  "
+          f"{stats['pages']:>5} pages ({stats['time'] / max(elapsed, 1e-6) * 100:3.0f}% fetching)  {db_calls:>6} DB calls  "
+          f"peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB")
+
+def bench(args):
+    server = subprocess.Popen(
+        [sys.executable, script, "serve", "--entries", str(args.entries), "--seed", str(args.seed), "--hostnames", str(args.hostnames),
+         "--clients", str(args.clients), "--qps", str(args.qps), "--block-rate", str(args.block_rate)],
+        stdout=subprocess.PIPE, text=True
+    )
+
+    try:
+        port = int(server.stdout.readline())
+        url = f"http://127.0.0.1:{port}"
+
+        downloader = load_downloader()
+        downloader.ADGUARD_URL = f"{url}/control/querylog"
+        downloader.SPOOL_DIR = None
+        downloader.METRICS_TEXTFILE = None
+        downloader.sketches = None
+
+        if args.page_limit:
+            downloader.ADGUARD_PAGE_LIMIT = args.page_limit
+        if args.batch_size:
+            downloader.DB_BATCH_SIZE = args.batch_size
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            if args.target == "sqlite":
+                path = os.path.join(tmp_dir, "bench.sqlite")
+                create_sqlite(path)
+
+                downloader.DB_SCHEMA = "legacy"
+                downloader.DB_ROLLUPS = False
+                downloader.DB_SOURCES = False
+                downloader.DB_PARTITIONS = None
+                downloader.db_connect = lambda: CountingConnection(SqliteConnection(path))
+            else:
+                if not args.database:
+                    sys.exit("--target mariadb needs --database naming a scratch database, querylog in it is emptied")
+
+                downloader.DB = dict(downloader.DB, database=args.database)
+                connect = downloader.db_connect
+                downloader.db_connect = lambda: CountingConnection(connect())
+
+                db = connect()
+                with db.cursor() as c:
+                    c.execute("DELETE FROM querylog")
+                    c.execute("DELETE FROM state WHERE k LIKE 'last_ts%%'")
+                    if downloader.DB_ROLLUPS:
+                        c.execute("DELETE FROM querylog_rollup")
+                db.close()
+
+            print(f"{args.entries} entries, page limit {downloader.ADGUARD_PAGE_LIMIT}, batch size {downloader.DB_BATCH_SIZE}, target {args.target}")
+            run_poll(downloader, "first poll")
+
+            urllib.request.urlopen(urllib.request.Request(f"{url}/bench/append?n={args.append}", method="POST")).read()
+            run_poll(downloader, "incremental")
+    finally:
+        server.terminate()
+        server.wait()
+
+def add_log_args(parser):
+    parser.add_argument("--entries", type=int, default=100000, help="Entries in the query log to start with")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the synthetic query log")
+    parser.add_argument("--hostnames", type=int, default=20000, help="Distinct hostnames, picked with a Zipf distribution")
+    parser.add_argument("--clients", type=int, default=50, help="Distinct clients, picked with a Zipf distribution")
+    parser.add_argument("--qps", type=float, default=20, help="Average queries per second the log is spread over")
+    parser.add_argument("--block-rate", type=float, default=0.15, help="Fraction of queries that are blocked")
+
+def main():
+    argparser = argparse.ArgumentParser(description="Benchmark adguard-log-downloader.py against a stand-in AdGuard Home.")
+    subparsers = argparser.add_subparsers(dest="command")
+
+    serve_parser = subparsers.add_parser("serve", help="Only run the stand-in AdGuard Home")
+    add_log_args(serve_parser)
+
+    add_log_args(argparser)
+    argparser.add_argument("--append", type=int, default=5000, help="Entries added before the incremental poll")
+    argparser.add_argument("--target", choices=["sqlite", "mariadb"], default="sqlite", help="Where the rows go")
+    argparser.add_argument("--database", help="Scratch MariaDB database for --target mariadb")
+    argparser.add_argument("--page-limit", type=int, help="Override ADGUARD_PAGE_LIMIT")
+    argparser.add_argument("--batch-size", type=int, help="Override DB_BATCH_SIZE")
+
+    args = argparser.parse_args()
+
+    if args.command == "serve":
+        serve(args)
+    else:
+        bench(args)
+
+if __name__ == "__main__":
+    main()
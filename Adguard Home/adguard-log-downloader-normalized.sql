@@ -0,0 +1,98 @@
+-- Normalized schema for adguard-log-downloader.py, set DB_SCHEMA = "normalized" in the script once this is in place.
+--
+-- Hostnames, clients, query types and rules are stored once in their own tables and querylog only holds their ids,
+-- answers are stored as one "type<TAB>value<TAB>ttl" line per answer instead of JSON. The querylog_expanded view has
+-- the same columns as the original querylog table for ad-hoc queries.
+--
+-- For a new install run adguard-log-downloader.sql first for the database, state table and user, then this file
+-- with the migration section swapped for the RENAME TABLE mentioned there.
+--
+-- The values in the dimension tables are compared byte for byte (armscii8_nopad_bin), with the database's default
+-- collation two rules that only differ in case or trailing spaces would share one row and the script couldn't find the
+-- id of the second. If the tables were made before this was added, change them with
+--   ALTER TABLE `hostnames` MODIFY `name` varchar(255) COLLATE armscii8_nopad_bin NOT NULL;
+--   ALTER TABLE `clients` MODIFY `client` varchar(64) COLLATE armscii8_nopad_bin NOT NULL;
+--   ALTER TABLE `qtypes` MODIFY `qtype` varchar(16) COLLATE armscii8_nopad_bin NOT NULL;
+--   ALTER TABLE `rules` MODIFY `rule` varchar(255) COLLATE armscii8_nopad_bin NOT NULL;
+
+USE `adguard`;
+
+CREATE TABLE `hostnames` (
+  `id` INT UNSIGNED NOT NULL AUTO_INCREMENT,
+  `name` varchar(255) COLLATE armscii8_nopad_bin NOT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `uniq_name` (`name`)
+) ENGINE=InnoDB;
+
+CREATE TABLE `clients` (
+  `id` MEDIUMINT UNSIGNED NOT NULL AUTO_INCREMENT,
+  `client` varchar(64) COLLATE armscii8_nopad_bin NOT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `uniq_client` (`client`)
+) ENGINE=InnoDB;
+
+CREATE TABLE `qtypes` (
+  `id` TINYINT UNSIGNED NOT NULL AUTO_INCREMENT,
+  `qtype` varchar(16) COLLATE armscii8_nopad_bin NOT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `uniq_qtype` (`qtype`)
+) ENGINE=InnoDB;
+
+CREATE TABLE `rules` (
+  `id` MEDIUMINT UNSIGNED NOT NULL AUTO_INCREMENT,
+  `rule` varchar(255) COLLATE armscii8_nopad_bin NOT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `uniq_rule` (`rule`)
+) ENGINE=InnoDB;
+
+CREATE TABLE `querylog_normalized` (
+  `id` INT UNSIGNED NOT NULL AUTO_INCREMENT,
+  `time` datetime(6) NOT NULL,
+  `hostname_id` INT UNSIGNED NOT NULL,
+  `client_id` MEDIUMINT UNSIGNED NOT NULL,
+  `qtype_id` TINYINT UNSIGNED NOT NULL,
+  `answers` text DEFAULT NULL,
+  `blocked` tinyint(1) DEFAULT NULL,
+  `rule_id` MEDIUMINT UNSIGNED DEFAULT NULL,
+  `ruleid` smallint(5) UNSIGNED DEFAULT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `uniq_event` (`time`,`hostname_id`,`client_id`,`qtype_id`),
+  KEY `hostname_blocked` (`hostname_id`,`blocked`)
+) ENGINE=InnoDB;
+
+-- Migration from the original querylog table, skip this section on a new install and just run
+--   RENAME TABLE `querylog_normalized` TO `querylog`;
+-- instead. Stop adguard-log-downloader.timer (or the daemon) first and set DB_SCHEMA = "normalized" before starting
+-- it again, the old table is kept as querylog_legacy until you drop it.
+
+INSERT IGNORE INTO `hostnames` (`name`) SELECT DISTINCT IFNULL(`hostname`, '') COLLATE armscii8_nopad_bin FROM `querylog`;
+INSERT IGNORE INTO `clients` (`client`) SELECT DISTINCT IFNULL(`client`, '') COLLATE armscii8_nopad_bin FROM `querylog`;
+INSERT IGNORE INTO `qtypes` (`qtype`) SELECT DISTINCT IFNULL(`qtype`, '') COLLATE armscii8_nopad_bin FROM `querylog`;
+INSERT IGNORE INTO `rules` (`rule`) SELECT DISTINCT `rule` COLLATE armscii8_nopad_bin FROM `querylog` WHERE `rule` IS NOT NULL AND `rule` != '';
+
+-- JSON_TABLE needs MariaDB 10.6 or later
+SET SESSION group_concat_max_len = 65535;
+
+INSERT IGNORE INTO `querylog_normalized` (`time`, `hostname_id`, `client_id`, `qtype_id`, `answers`, `blocked`, `rule_id`, `ruleid`)
+SELECT q.`time`, h.`id`, c.`id`, t.`id`,
+  (SELECT GROUP_CONCAT(CONCAT_WS('\t', IFNULL(a.`type`, ''), IFNULL(a.`value`, ''), IFNULL(a.`ttl`, '')) SEPARATOR '\n')
+     FROM JSON_TABLE(q.`answers`, '$[*]' COLUMNS (`type` varchar(16) PATH '$.type', `value` text PATH '$.value', `ttl` INT PATH '$.ttl')) a),
+  q.`blocked`, r.`id`, q.`ruleid`
+FROM `querylog` q
+JOIN `hostnames` h ON h.`name` = IFNULL(q.`hostname`, '')
+JOIN `clients` c ON c.`client` = IFNULL(q.`client`, '')
+JOIN `qtypes` t ON t.`qtype` = IFNULL(q.`qtype`, '')
+LEFT JOIN `rules` r ON r.`rule` = q.`rule`;
+
+RENAME TABLE `querylog` TO `querylog_legacy`, `querylog_normalized` TO `querylog`;
+
+-- End of the migration section
+
+-- Same columns as the original querylog table
+CREATE VIEW `querylog_expanded` AS
+SELECT q.`id`, q.`time`, h.`name` AS `hostname`, c.`client`, t.`qtype`, q.`answers`, q.`blocked`, r.`rule`, q.`ruleid`
+FROM `querylog` q
+JOIN `hostnames` h ON h.`id` = q.`hostname_id`
+JOIN `clients` c ON c.`id` = q.`client_id`
+JOIN `qtypes` t ON t.`id` = q.`qtype_id`
+LEFT JOIN `rules` r ON r.`id` = q.`rule_id`;
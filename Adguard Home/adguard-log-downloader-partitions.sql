@@ -0,0 +1,25 @@
+-- Partition querylog by day or week on `time` so old rows can be removed by dropping whole partitions instead of a
+-- long running DELETE, and so queries on a time range only read the partitions that range covers. Works with both
+-- the original and the normalized schema.
+--
+-- Stop adguard-log-downloader.timer (or the daemon) first, this copies the whole table. Change the date below to the
+-- first day that should get partitions of its own (a Monday for weekly partitions), everything before it stays in
+-- pold which retention drops once its newest rows are old enough. Afterwards set DB_PARTITIONS to "daily" or
+-- "weekly" in adguard-log-downloader.py and, optionally, DB_RETENTION_DAYS. The downloader splits the partitions it
+-- needs off pmax on every run, or every hour with --daemon.
+--
+-- MariaDB needs the partitioning column in every unique key, uniq_event already starts with it but the primary key
+-- has to be widened to (id, time).
+
+USE `adguard`;
+
+ALTER TABLE `querylog`
+  DROP PRIMARY KEY,
+  ADD PRIMARY KEY (`id`, `time`)
+  PARTITION BY RANGE COLUMNS(`time`) (
+    PARTITION `pold` VALUES LESS THAN ('2025-01-01 00:00:00'),
+    PARTITION `pmax` VALUES LESS THAN (MAXVALUE)
+  );
+
+-- To see which partitions a query reads
+--   EXPLAIN PARTITIONS SELECT COUNT(*) FROM querylog WHERE `time` >= '2025-01-06' AND `time` < '2025-01-07';
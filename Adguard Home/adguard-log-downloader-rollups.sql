@@ -0,0 +1,25 @@
+-- Rollup table for adguard-log-downloader.py, set DB_ROLLUPS = True in the script once this is in place and then
+-- fill it from the existing rows with
+--   ./adguard-query.py rebuild
+--
+-- Every minute and every hour has one row per hostname, client, query type and filter list id (dim) and per
+-- blocked/allowed with the number of queries. The downloader recalculates the minutes covered by each page it writes,
+-- and the hours they fall in, in the same transaction as the page.
+--
+-- value is compared byte for byte (armscii8_nopad_bin) like the dimension tables of the normalized schema, otherwise
+-- two hostnames that only differ in case would end up in the same row. If the table was made before this was added,
+-- change it with
+--   ALTER TABLE `querylog_rollup` MODIFY `value` varchar(255) COLLATE armscii8_nopad_bin NOT NULL;
+
+USE `adguard`;
+
+CREATE TABLE `querylog_rollup` (
+  `granularity` ENUM('minute','hour') NOT NULL,
+  `bucket` datetime NOT NULL,
+  `dim` ENUM('hostname','client','qtype','ruleid') NOT NULL,
+  `value` varchar(255) COLLATE armscii8_nopad_bin NOT NULL,
+  `blocked` tinyint(1) NOT NULL,
+  `queries` INT UNSIGNED NOT NULL,
+  PRIMARY KEY (`granularity`,`bucket`,`dim`,`value`,`blocked`),
+  KEY `dim_blocked` (`granularity`,`dim`,`blocked`,`bucket`)
+) ENGINE=InnoDB;
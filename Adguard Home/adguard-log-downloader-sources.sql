@@ -0,0 +1,32 @@
+-- Source column for adguard-log-downloader.py downloading from more than one AdGuard Home instance, set
+-- DB_SOURCES = True in the script once this is in place and start it with --config listing the instances.
+--
+-- Every row gets the name of the instance it came from, rows from before this have an empty source. The source is
+-- part of uniq_event so the same query seen by two resolvers is kept once per resolver. state.k is widened for the
+-- per instance watermark and backfill keys.
+--
+-- Stop adguard-log-downloader.timer (or the daemon) first, this rebuilds querylog.
+
+USE `adguard`;
+
+ALTER TABLE `state` MODIFY `k` varchar(64) NOT NULL;
+
+-- Original schema from adguard-log-downloader.sql
+ALTER TABLE `querylog`
+  ADD COLUMN `source` varchar(32) NOT NULL DEFAULT '' AFTER `time`,
+  DROP INDEX `uniq_event`,
+  ADD UNIQUE KEY `uniq_event` (`time`,`source`,`hostname`,`client`,`qtype`);
+
+-- Or for the normalized schema from adguard-log-downloader-normalized.sql use this instead of the statement above
+-- ALTER TABLE `querylog`
+--   ADD COLUMN `source` varchar(32) NOT NULL DEFAULT '' AFTER `time`,
+--   DROP INDEX `uniq_event`,
+--   ADD UNIQUE KEY `uniq_event` (`time`,`source`,`hostname_id`,`client_id`,`qtype_id`);
+--
+-- CREATE OR REPLACE VIEW `querylog_expanded` AS
+-- SELECT q.`id`, q.`time`, q.`source`, h.`name` AS `hostname`, c.`client`, t.`qtype`, q.`answers`, q.`blocked`, r.`rule`, q.`ruleid`
+-- FROM `querylog` q
+-- JOIN `hostnames` h ON h.`id` = q.`hostname_id`
+-- JOIN `clients` c ON c.`id` = q.`client_id`
+-- JOIN `qtypes` t ON t.`id` = q.`qtype_id`
+-- LEFT JOIN `rules` r ON r.`id` = q.`rule_id`;
@@ -1,20 +1,51 @@
 #!/usr/bin/python3
 
+import argparse
+import base64
+import collections
+import configparser
+import contextlib
 import datetime
+import hashlib
+import heapq
 import json
+import lzma
+import math
+import os
 import pymysql
+import re
 import requests
+import signal
+import struct
+import sys
+import threading
 import time
 
 from dateutil import parser
 from zoneinfo import ZoneInfo
 
+# orjson is optional, it decodes the pages and encodes the answers several times faster than json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Config Section
 
 ADGUARD_URL = "https://router.example.com:8443/control/querylog"
 ADGUARD_USER = "adguard-username"
 ADGUARD_PASS = "adguard-password"
 
+# To download from more than one AdGuard Home instance list them in a file given with --config instead, one section
+# per instance named after it (at most 32 characters) with url, user and password in it, eg
+#   [primary]
+#   url = https://router.example.com:8443/control/querylog
+#   user = adguard-username
+#   password = adguard-password
+# Each instance has its own watermark and is polled in its own thread, this needs DB_SOURCES. A one-shot run from the
+# timer still lasts as long as its slowest instance (up to ADGUARD_TIMEOUT for every retry of every page), only
+# --daemon keeps an unreachable router from holding up the others
+
 DB = {
     "host": "localhost",
     "user": "database-username",
@@ -25,123 +56,1564 @@ DB = {
 
 ADGUARD_PAGE_LIMIT = 500
 
+# HTTP timeout in seconds, and how often and with what backoff factor to retry connection errors and 429/5xx replies
+ADGUARD_TIMEOUT = 10
+ADGUARD_RETRIES = 3
+ADGUARD_BACKOFF = 0.5
+
+# Shortest and longest time in seconds between polls with --daemon
+DAEMON_MIN_INTERVAL = 2
+DAEMON_MAX_INTERVAL = 60
+
+# Rows sent to MariaDB per multi-row INSERT, each page is still written in a single transaction
+DB_BATCH_SIZE = 500
+
+# "legacy" for the original querylog table from adguard-log-downloader.sql, or "normalized" once the tables from
+# adguard-log-downloader-normalized.sql are in place. The normalized schema keeps hostnames, clients, query types and
+# rules in their own tables and the ids of the most recently used DICT_CACHE_SIZE values of each in memory
+DB_SCHEMA = "legacy"
+DICT_CACHE_SIZE = 100000
+
+# Keep the per minute and per hour counts in querylog_rollup up to date, needs adguard-log-downloader-rollups.sql
+DB_ROLLUPS = False
+
+# Store the name of the instance each row came from in querylog.source, needs adguard-log-downloader-sources.sql
+DB_SOURCES = False
+
+# Directory pages are spooled to when MariaDB can't be reached or a page can't be committed, so they aren't lost
+# while the watermark moves on. The spool is replayed SPOOL_REPLAY_BATCH rows per transaction once MariaDB is back,
+# at the start of each run, every DAEMON_MAX_INTERVAL with --daemon or with --replay. None turns spooling off, the
+# systemd units make /var/lib/adguard-log-downloader writable for it
+SPOOL_DIR = None
+SPOOL_REPLAY_BATCH = 20000
+
+# Keep running counts of today's busiest hostnames, blocked hostnames and clients (Space-Saving, SKETCH_TOP_K
+# counters each) and of the distinct clients per busy hostname (HyperLogLog, 2**SKETCH_HLL_PRECISION bytes each) while
+# ingesting. They are saved to SKETCH_FILE every DAEMON_MAX_INTERVAL and at the end of a run, and with --daemon served
+# as JSON on SKETCH_HTTP, see serve_sketches() for the paths
+SKETCHES = False
+SKETCH_TOP_K = 1000
+SKETCH_HLL_PRECISION = 10
+SKETCH_FILE = "/var/lib/adguard-log-downloader/sketches.json"
+SKETCH_HTTP = ("127.0.0.1", 8737)
+
+# "daily" or "weekly" once querylog is partitioned with adguard-log-downloader-partitions.sql, each run makes sure
+# there are DB_PARTITIONS_AHEAD empty partitions ready past today. With DB_RETENTION_DAYS set, partitions that only
+# hold rows older than that many days are dropped
+DB_PARTITIONS = None
+DB_PARTITIONS_AHEAD = 7
+DB_RETENTION_DAYS = None
+
+# Ingestion metrics in Prometheus text format, written to METRICS_TEXTFILE (eg
+# /var/lib/prometheus/node-exporter/adguard-log-downloader.prom for node_exporter's textfile collector, the systemd units
+# make that directory writable when it exists) at the end of each run and every DAEMON_MAX_INTERVAL with --daemon, and
+# served on METRICS_HTTP at /metrics with --daemon. Every run carries on from the values in METRICS_TEXTFILE so
+# counters keep going up across timer runs
+METRICS_TEXTFILE = None
+METRICS_HTTP = None
+
 # Nothing is configurable below this line
 
+Instance = collections.namedtuple("Instance", "name url user password")
+
 local_tz = datetime.datetime.now().astimezone().tzinfo
 
+# Timezones for the UTC offsets seen in querylog timestamps, there's usually only one or two
+offset_tz = {"Z": datetime.timezone.utc}
+
+# Everything written to MariaDB has to be ASCII, the database is armscii8 and anything else is rejected with error 1366
+json_encode = json.JSONEncoder(separators=(",", ":")).encode
+
+if orjson is not None:
+    json_loads = orjson.loads
+
+    # orjson always writes UTF-8, the odd value with anything outside ASCII in it goes through json to be escaped
+    def json_dumps(value):
+        data = orjson.dumps(value)
+        return data.decode() if data.isascii() else json_encode(value)
+else:
+    json_loads = json.loads
+    json_dumps = json_encode
+
+# HTTP sessions and DB connections are per thread so backfill workers don't share them
+local = threading.local()
+
+fetch_lock = threading.Lock()
+
+# Pages are written one at a time while rollups are on, two transactions recalculating the same minutes would
+# deadlock each other
+rollup_lock = threading.Lock()
+
+# Appends to the spool and handing it over to replay_spool() are done one at a time. The spool left by an earlier
+# process is checked for a chunk cut short by a crash before the first append
+spool_lock = threading.Lock()
+spool_checked = False
+
+# Dimension tables of the normalized schema, logical column to (table, value column), and the value to id caches
+DIMENSIONS = {
+    "hostname": ("hostnames", "name"),
+    "client": ("clients", "client"),
+    "qtype": ("qtypes", "qtype"),
+    "rule": ("rules", "rule")
+}
+
+id_cache = {dim: collections.OrderedDict() for dim in DIMENSIONS}
+id_cache_lock = threading.Lock()
+
+# Columns counted in querylog_rollup
+ROLLUP_DIMENSIONS = ("hostname", "client", "qtype", "ruleid")
+
+# Length of each querylog partition and how often --daemon checks them
+PARTITION_PERIODS = {"daily": datetime.timedelta(days=1), "weekly": datetime.timedelta(weeks=1)}
+PARTITION_CHECK_INTERVAL = 3600
+
+# Page fetch timings per instance for the summary at the end of a run
+fetch_stats = collections.defaultdict(lambda: {"pages": 0, "time": 0.0, "bytes": 0})
+
+# Metric name to (type, help, histogram buckets)
+METRICS = {
+    "adguard_fetch_seconds": ("histogram", "Time taken to fetch and decode one querylog page", (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)),
+    "adguard_fetch_bytes_total": ("counter", "Bytes of querylog pages fetched", None),
+    "adguard_poll_pages": ("histogram", "Pages walked back per poll until the watermark was reached", (1, 2, 3, 5, 10, 20, 50, 100)),
+    "adguard_poll_new_entries": ("histogram", "Entries newer than the watermark per poll", (0, 10, 50, 100, 250, 500, 1000, 5000, 10000)),
+    "adguard_polls_total": ("counter", "Polls finished", None),
+    "adguard_poll_failures_total": ("counter", "Polls that failed", None),
+    "adguard_write_seconds": ("histogram", "Time taken to write one page to MariaDB", (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)),
+    "adguard_rows_inserted_total": ("counter", "Rows inserted into querylog", None),
+    "adguard_rows_ignored_total": ("counter", "Rows INSERT IGNORE skipped as already in querylog", None),
+    "adguard_rows_spooled_total": ("counter", "Rows written to the spool instead of MariaDB", None),
+    "adguard_rows_replayed_total": ("counter", "Rows loaded into MariaDB from the spool", None),
+    "adguard_spool_bytes": ("gauge", "Size of the spool waiting to be replayed", None),
+    "adguard_watermark_lag_seconds": ("gauge", "How far the newest stored entry trails the time the poll finished", None),
+    "adguard_last_poll_timestamp_seconds": ("gauge", "Unix time the last successful poll finished", None)
+}
+
+# Label values can be instance names from --config, these characters have to be escaped in the text format
+LABEL_ESCAPES = str.maketrans({"\\": "\\\\", '"': '\\"', "\n": "\\n"})
+LABEL_UNESCAPES = {"n": "\n"}
+
+# (name, labels) to value, histograms keep [bucket counts, sum, count]
+metrics = {}
+metrics_lock = threading.Lock()
+
+def metric_add(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        metrics[key] = metrics.get(key, 0) + value
+
+def metric_set(name, value, **labels):
+    with metrics_lock:
+        metrics[(name, tuple(sorted(labels.items())))] = value
+
+def metric_observe(name, value, **labels):
+    buckets = METRICS[name][2]
+    key = (name, tuple(sorted(labels.items())))
+
+    with metrics_lock:
+        histogram = metrics.get(key)
+        if histogram is None:
+            histogram = metrics[key] = [[0] * len(buckets), 0.0, 0]
+
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                histogram[0][i] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+def format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ""
+
+    return "{" + ",".join(f'{k}="{str(v).translate(LABEL_ESCAPES)}"' for k, v in labels) + "}"
+
+# The (name, labels, value) of each sample in text written by render_metrics()
+def parse_metrics(text):
+    for line in text.splitlines():
+        match = re.fullmatch(r'(\w+)(?:\{(.*)\})? (\S+)', line)
+        if not match:
+            continue
+
+        name, labels, value = match.groups()
+        labels = [(k, re.sub(r'\\(.)', lambda m: LABEL_UNESCAPES.get(m.group(1), m.group(1)), v)) for k, v in re.findall(r'(\w+)="((?:[^"\\]|\\.)*)"', labels or "")]
+        yield name, labels, float(value)
+
+# Carry on from the counters, histograms and gauges of the previous run in METRICS_TEXTFILE, with the timer every run
+# is a new process and counters that dropped back to zero every minute would throw rate() and increase() off
+def load_metrics():
+    try:
+        with open(METRICS_TEXTFILE) as f:
+            text = f.read()
+    except OSError:
+        return
+
+    with metrics_lock:
+        for name, labels, value in parse_metrics(text):
+            base, _, suffix = name.rpartition("_")
+
+            if name in METRICS and METRICS[name][0] != "histogram":
+                metrics[(name, tuple(sorted(labels)))] = int(value) if value.is_integer() else value
+                continue
+
+            if base not in METRICS or METRICS[base][0] != "histogram":
+                continue
+
+            buckets = METRICS[base][2]
+            le = dict(labels).get("le")
+            key = (base, tuple(sorted((k, v) for k, v in labels if k != "le")))
+            histogram = metrics.setdefault(key, [[0] * len(buckets), 0.0, 0])
+
+            if suffix == "bucket" and le != "+Inf":
+                for i, bound in enumerate(buckets):
+                    if str(bound) == le:
+                        histogram[0][i] = int(value)
+            elif suffix == "sum":
+                histogram[1] = value
+            elif suffix == "count":
+                histogram[2] = int(value)
+
+def render_metrics():
+    lines = []
+
+    with metrics_lock:
+        for name, (kind, help, buckets) in METRICS.items():
+            series = [(labels, value) for (metric, labels), value in sorted(metrics.items()) if metric == name]
+            if not series:
+                continue
+
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+
+            for labels, value in series:
+                if kind != "histogram":
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+                    continue
+
+                counts, total, count = value
+                for bound, n in zip(buckets, counts):
+                    lines.append(f"{name}_bucket{format_labels(labels, [('le', bound)])} {n}")
+                lines.append(f"{name}_bucket{format_labels(labels, [('le', '+Inf')])} {count}")
+                lines.append(f"{name}_sum{format_labels(labels)} {total}")
+                lines.append(f"{name}_count{format_labels(labels)} {count}")
+
+    return "\n".join(lines) + "\n"
+
+# Written next to the file and renamed over it, node_exporter must never read half a file
+def write_metrics():
+    try:
+        tmp = f"{METRICS_TEXTFILE}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(render_metrics())
+        os.replace(tmp, METRICS_TEXTFILE)
+    except OSError as e:
+        print(f"Writing {METRICS_TEXTFILE} failed: {e}", file=sys.stderr)
+
+# Serve /metrics on METRICS_HTTP from a background thread
+def serve_metrics():
+    import http.server
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+
+            data = render_metrics().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(METRICS_HTTP, Handler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+
+    return server
+
 def db_connect():
     return pymysql.connect(**DB)
 
-def get_last_timestamp(db):
+# DB connection of the current thread, each poller and backfill worker has its own
+def get_db():
+    db = getattr(local, "db", None)
+    if db is None:
+        db = local.db = db_connect()
+
+    db.ping(reconnect=True)
+    return db
+
+# Same as get_db() but with a spool to fall back on None is returned while MariaDB can't be reached
+def get_db_or_spool():
+    try:
+        return get_db()
+    except pymysql.MySQLError as e:
+        if SPOOL_DIR is None:
+            raise
+
+        print(f"Can't reach MariaDB, spooling to {SPOOL_DIR}: {e}", file=sys.stderr)
+        return None
+
+def get_state(db, k):
     with db.cursor() as c:
-        c.execute("SELECT v FROM state WHERE k='last_ts'")
+        c.execute("SELECT v FROM state WHERE k=%s", (k,))
         row = c.fetchone()
         return row[0] if row else None
 
-def set_last_timestamp(db, ts):
-    with db.cursor() as c:
-        c.execute(
-            """
-            INSERT INTO state (k, v)
-            VALUES ('last_ts', %s)
-            ON DUPLICATE KEY UPDATE v = VALUES(v)
-            """,
-            (ts,)
+def set_state(c, k, v):
+    c.execute(
+        """
+        INSERT INTO state (k, v)
+        VALUES (%s, %s)
+        ON DUPLICATE KEY UPDATE v = VALUES(v)
+        """,
+        (k, v)
+    )
+
+# The instance from the constants at the top keeps the original last_ts key
+def watermark_key(instance):
+    return f"last_ts:{instance.name}" if instance.name else "last_ts"
+
+# The newer of two watermarks, either can be None
+def newest_ts(a, b):
+    if a is None or b is None:
+        return a or b
+
+    return a if parse_rfc3339(a) >= parse_rfc3339(b) else b
+
+# A watermark spooled while MariaDB was away can be newer than the one in state. db is None while MariaDB is away
+def get_last_timestamp(db, instance):
+    key = watermark_key(instance)
+    last_ts = get_state(db, key) if db is not None else None
+
+    if SPOOL_DIR is not None:
+        last_ts = newest_ts(last_ts, read_spool_state().get(key))
+
+    return last_ts
+
+# The instances listed in path, or the one from the constants at the top without a name when there's no config file
+def load_instances(path=None):
+    if path is None:
+        return [Instance("", ADGUARD_URL, ADGUARD_USER, ADGUARD_PASS)]
+
+    config = configparser.ConfigParser(interpolation=None)
+    if not config.read(path):
+        sys.exit(f"Can't read {path}")
+
+    instances = []
+    for name in config.sections():
+        section = config[name]
+
+        if len(name) > 32:
+            sys.exit(f"{path}: instance name {name} is longer than 32 characters")
+        if "url" not in section:
+            sys.exit(f"{path}: instance {name} has no url")
+
+        instances.append(Instance(name, section["url"], section.get("user", ""), section.get("password", "")))
+
+    if not instances:
+        sys.exit(f"{path} doesn't list any instances")
+
+    return instances
+
+# One session per instance for the whole run so every page after the first reuses the same TLS connection to the
+# router
+def get_session(instance):
+    sessions = getattr(local, "sessions", None)
+    if sessions is None:
+        sessions = local.sessions = {}
+
+    session = sessions.get(instance.name)
+
+    if session is None:
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        retry = Retry(
+            total=ADGUARD_RETRIES,
+            backoff_factor=ADGUARD_BACKOFF,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=("GET",)
         )
 
-def fetch_page(before=None):
+        session = requests.Session()
+        session.auth = (instance.user, instance.password)
+        session.headers["Accept-Encoding"] = "gzip, deflate"
+        session.mount("https://", HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=1))
+        session.mount("http://", HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=1))
+        sessions[instance.name] = session
+
+    return session
+
+def fetch_page(instance, before=None):
     params = {"limit": ADGUARD_PAGE_LIMIT}
     params["response_status"] = "all"
 
     if before:
         params["older_than"] = before
 
-    r = requests.get(
-        ADGUARD_URL,
-        auth=(ADGUARD_USER, ADGUARD_PASS),
+    start = time.monotonic()
+
+    r = get_session(instance).get(
+        instance.url,
         params=params,
-        timeout=10
+        timeout=ADGUARD_TIMEOUT
     )
 
     r.raise_for_status()
-    return r.json()
+    data = json_loads(r.content)
 
-def main():
-    db = db_connect()
-    last_ts = get_last_timestamp(db)
+    elapsed = time.monotonic() - start
+    size = int(r.headers.get("Content-Length", len(r.content)))
+
+    with fetch_lock:
+        stats = fetch_stats[instance.name]
+        stats["pages"] += 1
+        stats["time"] += elapsed
+        stats["bytes"] += size
+
+    metric_observe("adguard_fetch_seconds", elapsed, instance=instance.name or "default")
+    metric_add("adguard_fetch_bytes_total", size, instance=instance.name or "default")
+
+    return data
+
+def select_ids(c, table, column, values):
+    c.execute(f"SELECT id, `{column}` FROM `{table}` WHERE `{column}` IN ({','.join(['%s'] * len(values))})", list(values))
+    return {value: id for id, value in c.fetchall()}
+
+# Map values of a dimension to their ids, anything not in the LRU cache is looked up in one query and anything not in
+# the table yet is added in one more. Only missing values are inserted so INSERT IGNORE doesn't burn through the small
+# auto increment ranges of tables like qtypes
+def get_ids(db, dim, values):
+    cache = id_cache[dim]
+    ids = {}
+    missing = set()
+
+    with id_cache_lock:
+        for value in values:
+            if value in cache:
+                cache.move_to_end(value)
+                ids[value] = cache[value]
+            else:
+                missing.add(value)
+
+    if missing:
+        table, column = DIMENSIONS[dim]
+
+        with db.cursor() as c:
+            found = select_ids(c, table, column, missing)
+
+            new_values = missing - found.keys()
+            if new_values:
+                c.executemany(f"INSERT IGNORE INTO `{table}` (`{column}`) VALUES (%s)", [(value,) for value in new_values])
+                found.update(select_ids(c, table, column, new_values))
+
+        # Only happens when the table still compares values ignoring case, see adguard-log-downloader-normalized.sql
+        if missing - found.keys():
+            raise ValueError(f"{table}.{column} has no exact match for {sorted(missing - found.keys())[:5]}, it needs the armscii8_nopad_bin collation")
+
+        ids.update(found)
+
+        with id_cache_lock:
+            for value, id in found.items():
+                cache[value] = id
+            while len(cache) > DICT_CACHE_SIZE:
+                cache.popitem(last=False)
+
+    return ids
+
+# Swap the hostname, client, qtype and rule of each row for their ids in the dimension tables, the source if there is
+# one is left as it is. This happens before the page's transaction so a rolled back page can't leave ids in the cache
+# that were never committed
+def encode_rows(db, rows):
+    hostnames = get_ids(db, "hostname", {row[1] or "" for row in rows})
+    clients = get_ids(db, "client", {row[2] or "" for row in rows})
+    qtypes = get_ids(db, "qtype", {row[3] or "" for row in rows})
+    rules = get_ids(db, "rule", {row[6] for row in rows if row[6]})
+
+    return [
+        (dt, hostnames[hostname or ""], clients[client or ""], qtypes[qtype or ""], answers, blocked, rules[rule] if rule else None, ruleid, *source)
+        for dt, hostname, client, qtype, answers, blocked, rule, ruleid, *source in rows
+    ]
+
+# Recalculate the rollups for every minute from start up to end from the raw rows, and then the hours those minutes
+# are in from the minutes. Working from the raw rows means rows INSERT IGNORE skipped as duplicates are never counted
+# twice. start and end are naive local times on minute boundaries
+def update_rollups(c, start, end):
+    source = "querylog_expanded" if DB_SCHEMA == "normalized" else "querylog"
+
+    c.execute("DELETE FROM querylog_rollup WHERE granularity='minute' AND bucket >= %s AND bucket < %s", (start, end))
+
+    # Values that are distinct in the source can still collide in a querylog_rollup made before value was nopad_bin,
+    # those are added up instead of failing the page
+    for dim in ROLLUP_DIMENSIONS:
+        c.execute(f"""
+            INSERT INTO querylog_rollup (granularity, bucket, dim, value, blocked, queries)
+            SELECT 'minute', DATE_FORMAT(`time`, '%%Y-%%m-%%d %%H:%%i:00'), '{dim}', IFNULL(`{dim}`, ''), IFNULL(blocked, 0), COUNT(*)
+            FROM `{source}`
+            WHERE `time` >= %s AND `time` < %s
+            GROUP BY 2, 4, 5
+            ON DUPLICATE KEY UPDATE queries = queries + VALUES(queries)
+        """, (start, end))
+
+    hour_start = start.replace(minute=0)
+    hour_end = (end - datetime.timedelta(microseconds=1)).replace(minute=0, second=0, microsecond=0) + datetime.timedelta(hours=1)
+
+    c.execute("DELETE FROM querylog_rollup WHERE granularity='hour' AND bucket >= %s AND bucket < %s", (hour_start, hour_end))
+    c.execute("""
+        INSERT INTO querylog_rollup (granularity, bucket, dim, value, blocked, queries)
+        SELECT 'hour', DATE_FORMAT(bucket, '%%Y-%%m-%%d %%H:00:00'), dim, value, blocked, SUM(queries)
+        FROM querylog_rollup
+        WHERE granularity='minute' AND bucket >= %s AND bucket < %s
+        GROUP BY 2, 3, 4, 5
+    """, (hour_start, hour_end))
+
+# The minutes a page of rows covers, as naive local times to match what is stored
+def rollup_range(rows):
+    times = [row[0].replace(tzinfo=None) for row in rows]
+    start = min(times).replace(second=0, microsecond=0)
+    end = max(times).replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+
+    return start, end
+
+# The RANGE COLUMNS partitions of querylog in order as (name, upper bound), the catch-all partition has None as its bound
+def get_partitions(db):
+    with db.cursor() as c:
+        c.execute("""
+            SELECT PARTITION_NAME, PARTITION_DESCRIPTION
+            FROM information_schema.PARTITIONS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'querylog' AND PARTITION_NAME IS NOT NULL
+            ORDER BY PARTITION_ORDINAL_POSITION
+        """)
+        rows = c.fetchall()
+
+    partitions = []
+    for name, description in rows:
+        if description == "MAXVALUE":
+            partitions.append((name, None))
+        else:
+            partitions.append((name, datetime.datetime.fromisoformat(description.strip("'"))))
+
+    return partitions
+
+# Split new partitions off the front of the catch-all partition until there are DB_PARTITIONS_AHEAD past today, then
+# drop the ones that are entirely older than DB_RETENTION_DAYS. Partitions are named after the first day they hold
+# and all bounds are midnight local time, the same as the stored times
+def maintain_partitions(db):
+    period = PARTITION_PERIODS[DB_PARTITIONS]
+    partitions = get_partitions(db)
+
+    if not partitions or partitions[-1][1] is not None:
+        print("querylog has no MAXVALUE partition, run adguard-log-downloader-partitions.sql first", file=sys.stderr)
+        return
+
+    today = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    bounds = [bound for name, bound in partitions if bound is not None]
+    catch_all = partitions[-1][0]
+
+    new = []
+    if bounds:
+        lower = bounds[-1]
+    else:
+        lower = today - datetime.timedelta(days=today.weekday()) if DB_PARTITIONS == "weekly" else today
+    while lower <= today + period * DB_PARTITIONS_AHEAD:
+        upper = lower + period
+        new.append(f"PARTITION p{lower:%Y%m%d} VALUES LESS THAN ('{upper:%Y-%m-%d %H:%M:%S}')")
+        lower = upper
+
+    with db.cursor() as c:
+        if new:
+            c.execute(f"ALTER TABLE querylog REORGANIZE PARTITION `{catch_all}` INTO ({', '.join(new)}, PARTITION `{catch_all}` VALUES LESS THAN (MAXVALUE))")
+            print(f"Added {len(new)} querylog partitions up to {lower:%Y-%m-%d}")
+
+        if DB_RETENTION_DAYS:
+            cutoff = today - datetime.timedelta(days=DB_RETENTION_DAYS)
+            expired = [name for name, bound in partitions[:-1] if bound <= cutoff]
+
+            if expired:
+                c.execute(f"ALTER TABLE querylog DROP PARTITION {', '.join(f'`{name}`' for name in expired)}")
+                print(f"Dropped {len(expired)} querylog partitions older than {cutoff:%Y-%m-%d}")
+
+# Write one page of rows in a single transaction, any state keys given (last_ts or backfill progress) are updated in
+# the same transaction so they only ever cover rows that are actually committed. Returns how many rows were inserted,
+# the rest were already there
+def write_page(db, rows, state=None):
+    if DB_SCHEMA == "normalized":
+        columns = "time, hostname_id, client_id, qtype_id, answers, blocked, rule_id, ruleid"
+        if rows:
+            rows = encode_rows(db, rows)
+    else:
+        columns = "time, hostname, client, qtype, answers, blocked, rule, ruleid"
+
+    if DB_SOURCES:
+        columns += ", source"
+
+    query = f"INSERT IGNORE INTO querylog ({columns}) VALUES ({','.join(['%s'] * (columns.count(',') + 1))})"
+
+    inserted = 0
+
+    with rollup_lock if DB_ROLLUPS and rows else contextlib.nullcontext():
+        db.begin()
+
+        try:
+            with db.cursor() as c:
+                for i in range(0, len(rows), DB_BATCH_SIZE):
+                    inserted += c.executemany(query, rows[i:i + DB_BATCH_SIZE]) or 0
+
+                if DB_ROLLUPS and rows:
+                    update_rollups(c, *rollup_range(rows))
+
+                for k, v in (state or {}).items():
+                    set_state(c, k, v)
+
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+    return inserted
+
+# Write a page to MariaDB, or to the spool if there's no connection or it's lost, timed out or the server is
+# restarting. Errors in the page itself still go up to the caller. Returns the rows inserted, or None if the page was
+# spooled. Committed watermarks are kept in the spool's state.json too so a run that starts while MariaDB is away
+# knows where to carry on from
+def store_page(db, rows, state=None):
+    if SPOOL_DIR is None:
+        return write_page(db, rows, state)
+
+    if db is not None:
+        try:
+            inserted = write_page(db, rows, state)
+        except (pymysql.err.OperationalError, pymysql.err.InterfaceError) as e:
+            print(f"Writing to MariaDB failed, spooling the page instead: {e}", file=sys.stderr)
+        else:
+            if state:
+                with spool_lock:
+                    write_spool_state(state)
+            return inserted
+
+    spool_page(rows, state)
+    return None
+
+def read_spool_state():
+    try:
+        with open(os.path.join(SPOOL_DIR, "state.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+# Move the state keys in SPOOL_DIR/state.json forward to the ones given, the caller holds spool_lock
+def write_spool_state(state):
+    spooled = read_spool_state()
+    for k, v in state.items():
+        spooled[k] = newest_ts(spooled.get(k), v)
+
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    tmp = os.path.join(SPOOL_DIR, "state.json.tmp")
+    with open(tmp, "w") as f:
+        json.dump(spooled, f)
+    os.replace(tmp, os.path.join(SPOOL_DIR, "state.json"))
+
+# Offset just past the last complete chunk in a spool file, only the lengths are read
+def spool_end(path):
+    size = os.path.getsize(path)
+    end = 0
+
+    with open(path, "rb") as f:
+        while end + 4 <= size:
+            f.seek(end)
+            length = struct.unpack("!I", f.read(4))[0]
+            if end + 4 + length > size:
+                break
+            end += 4 + length
+
+    return end
+
+# Cut a chunk left incomplete by a crash off the end of the spool, chunks appended after it could never be read back
+def truncate_spool(path):
+    if not os.path.exists(path):
+        return
+
+    size = os.path.getsize(path)
+    end = spool_end(path)
+
+    if end < size:
+        with open(path, "r+b") as f:
+            f.truncate(end)
+            os.fsync(f.fileno())
+        print(f"Cut {size - end} bytes of an incomplete chunk off the end of {path}", file=sys.stderr)
+
+# Append the rows and state keys of a page to SPOOL_DIR/pages.spool as one xz compressed chunk with a 4 byte length in
+# front of it, and keep the newest spooled value of each state key in SPOOL_DIR/state.json. A failed append is cut off
+# again so the next one doesn't end up behind half a chunk
+def spool_page(rows, state=None):
+    global spool_checked
+
+    payload = {"rows": [[row[0].isoformat(), *row[1:]] for row in rows], "state": state or {}}
+    chunk = lzma.compress(json_dumps(payload).encode())
+
+    with spool_lock:
+        os.makedirs(SPOOL_DIR, exist_ok=True)
+        path = os.path.join(SPOOL_DIR, "pages.spool")
+
+        if not spool_checked:
+            truncate_spool(path)
+            spool_checked = True
+
+        with open(path, "ab") as f:
+            start = f.tell()
+            try:
+                f.write(struct.pack("!I", len(chunk)) + chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            except OSError:
+                f.truncate(start)
+                raise
+
+        if state:
+            write_spool_state(state)
+
+        size = os.path.getsize(path)
+
+    metric_add("adguard_rows_spooled_total", len(rows))
+    metric_set("adguard_spool_bytes", size)
+    print(f"Spooled {len(rows)} rows, {size} bytes waiting in {path}")
+
+class SpoolDamaged(Exception):
+    pass
+
+# The (rows, state) of each chunk in a spool file, SpoolDamaged is raised at a chunk that can't be read
+def read_spool(path):
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(4)
+            if not header:
+                return
+
+            chunk = f.read(struct.unpack("!I", header)[0]) if len(header) == 4 else b""
+            try:
+                payload = json_loads(lzma.decompress(chunk))
+            except (lzma.LZMAError, ValueError, EOFError):
+                raise SpoolDamaged(f"{path} has a damaged chunk at offset {f.tell() - len(chunk) - len(header)}")
+
+            rows = [(datetime.datetime.fromisoformat(row[0]), *row[1:]) for row in payload["rows"]]
+            yield rows, payload["state"]
+
+# Load one spool file into MariaDB, returns the number of rows, the time of the oldest one and whether the file was
+# damaged. Everything up to a damaged chunk is still loaded
+def replay_file(db, path):
+    total_rows = 0
+    oldest = None
+    damaged = False
+    rows = []
+    state = {}
+
+    try:
+        for chunk_rows, chunk_state in read_spool(path):
+            rows.extend(chunk_rows)
+            for k, v in chunk_state.items():
+                state[k] = newest_ts(state.get(k), v)
+
+            if chunk_rows:
+                first = min(row[0] for row in chunk_rows)
+                oldest = first if oldest is None or first < oldest else oldest
+
+            if len(rows) >= SPOOL_REPLAY_BATCH:
+                write_page(db, rows)
+                metric_add("adguard_rows_replayed_total", len(rows))
+                total_rows += len(rows)
+                rows = []
+    except SpoolDamaged as e:
+        print(e, file=sys.stderr)
+        damaged = True
+
+    state = {k: v for k, v in state.items() if newest_ts(get_state(db, k), v) == v}
+
+    write_page(db, rows, state)
+    metric_add("adguard_rows_replayed_total", len(rows))
+    total_rows += len(rows)
+
+    return total_rows, oldest, damaged
+
+# Load everything spooled so far into MariaDB. pages.spool is renamed out of the way first so pollers can keep
+# spooling into a new one, files are only deleted once all of their rows are committed and one that fails part way is
+# picked up again next time, INSERT IGNORE skips the rows that already made it. A file with a row MariaDB rejects
+# would fail the same way every time, it's renamed to .failed and left for a look by hand, as is a file with a damaged
+# chunk once everything before that chunk is loaded (.damaged). State keys are only moved forward
+def replay_spool(db):
+    with spool_lock:
+        if not os.path.isdir(SPOOL_DIR):
+            return 0
+
+        if os.path.exists(os.path.join(SPOOL_DIR, "pages.spool")):
+            os.replace(os.path.join(SPOOL_DIR, "pages.spool"), os.path.join(SPOOL_DIR, f"pages-{time.time_ns()}.replaying"))
 
+        files = sorted(os.path.join(SPOOL_DIR, name) for name in os.listdir(SPOOL_DIR) if name.endswith(".replaying"))
+
+    if not files:
+        return 0
+
+    size = sum(os.path.getsize(path) for path in files)
+    started = time.monotonic()
+    total_rows = 0
+    oldest = None
+
+    for path in files:
+        try:
+            rows, first, damaged = replay_file(db, path)
+        except (pymysql.err.DataError, pymysql.err.IntegrityError) as e:
+            failed = path[:-len(".replaying")] + ".failed"
+            os.replace(path, failed)
+            print(f"MariaDB rejected a row from {path}, moved it to {failed}: {e}", file=sys.stderr)
+            continue
+
+        total_rows += rows
+        if first is not None and (oldest is None or first < oldest):
+            oldest = first
+
+        if damaged:
+            os.replace(path, path[:-len(".replaying")] + ".damaged")
+            print(f"Kept what's left of {path} as {path[:-len('.replaying')]}.damaged", file=sys.stderr)
+        else:
+            os.remove(path)
+
+    elapsed = time.monotonic() - started
+    lag = f", the oldest row was {datetime.datetime.now(local_tz) - oldest} old" if oldest else ""
+    with spool_lock:
+        path = os.path.join(SPOOL_DIR, "pages.spool")
+        metric_set("adguard_spool_bytes", os.path.getsize(path) if os.path.exists(path) else 0)
+
+    print(f"Replayed {total_rows} rows from {len(files)} spool files ({size} bytes) in {elapsed:.2f}s ({total_rows / max(elapsed, 1e-6):.0f} rows/s){lag}")
+
+    return total_rows
+
+# Space-Saving top-k counter, once k items are tracked a new item takes over the smallest counter and inherits its
+# count as the possible overcount (error). The heap finds the smallest counter, stale entries in it are skipped
+class SpaceSaving:
+    def __init__(self, k):
+        self.k = k
+        self.counts = {}
+        self.heap = []
+
+    def _smallest(self):
+        while True:
+            count, item = self.heap[0]
+            if item in self.counts and self.counts[item][0] == count:
+                return item
+            heapq.heappop(self.heap)
+
+    def update(self, counter):
+        for item, n in counter.items():
+            if item in self.counts:
+                self.counts[item][0] += n
+            elif len(self.counts) < self.k:
+                self.counts[item] = [n, 0]
+            else:
+                smallest = self._smallest()
+                count, _ = self.counts.pop(smallest)
+                self.counts[item] = [count + n, count]
+
+            heapq.heappush(self.heap, (self.counts[item][0], item))
+
+        if len(self.heap) > 4 * self.k:
+            self.heap = [(count, item) for item, (count, error) in self.counts.items()]
+            heapq.heapify(self.heap)
+
+    def top(self, n):
+        return sorted(([item, count, error] for item, (count, error) in self.counts.items()), key=lambda t: -t[1])[:n]
+
+    def to_json(self):
+        return [[item, count, error] for item, (count, error) in self.counts.items()]
+
+    @classmethod
+    def from_json(cls, k, data):
+        sketch = cls(k)
+        for item, count, error in sorted(data, key=lambda t: -t[1])[:k]:
+            sketch.counts[item] = [count, error]
+        sketch.heap = [(count, item) for item, (count, error) in sketch.counts.items()]
+        heapq.heapify(sketch.heap)
+        return sketch
+
+# HyperLogLog distinct counter with 2**p one byte registers, standard error about 1.04 / sqrt(2**p)
+class HyperLogLog:
+    def __init__(self, p, registers=None):
+        self.p = p
+        self.registers = registers if registers is not None else bytearray(1 << p)
+
+    def add(self, value):
+        h = int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+        index = h >> (64 - self.p)
+        rank = (64 - self.p) - (h & ((1 << (64 - self.p)) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self):
+        m = len(self.registers)
+        estimate = (0.7213 / (1 + 1.079 / m)) * m * m / sum(2.0 ** -r for r in self.registers)
+
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+
+        return round(estimate)
+
+    def to_json(self):
+        return base64.b64encode(bytes(self.registers)).decode()
+
+    @classmethod
+    def from_json(cls, p, data):
+        return cls(p, bytearray(base64.b64decode(data)))
+
+# Today's sketches. Distinct clients are only counted for hostnames the hostname sketch is tracking, so memory stays
+# at SKETCH_TOP_K HyperLogLogs however many hostnames there are. Rows from another day than the sketches are ignored
+# and the first row of a new day starts them over
+class Sketches:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset(datetime.date.today())
+
+    def reset(self, day):
+        self.day = day
+        self.top = {name: SpaceSaving(SKETCH_TOP_K) for name in ("hostnames", "blocked", "clients")}
+        self.client_hll = {}
+        self.all_clients = HyperLogLog(SKETCH_HLL_PRECISION)
+
+    def update(self, rows):
+        today = datetime.date.today()
+
+        with self.lock:
+            if today != self.day:
+                self.reset(today)
+
+            hostnames = collections.Counter()
+            blocked = collections.Counter()
+            clients = collections.Counter()
+            pairs = set()
+
+            for row in rows:
+                if row[0].date() != today:
+                    continue
+
+                hostname, client = row[1] or "", row[2] or ""
+                hostnames[hostname] += 1
+                clients[client] += 1
+                if row[5]:
+                    blocked[hostname] += 1
+                pairs.add((hostname, client))
+
+            self.top["hostnames"].update(hostnames)
+            self.top["blocked"].update(blocked)
+            self.top["clients"].update(clients)
+
+            tracked = self.top["hostnames"].counts
+            for hostname in list(self.client_hll):
+                if hostname not in tracked:
+                    del self.client_hll[hostname]
+
+            for hostname, client in pairs:
+                self.all_clients.add(client)
+                if hostname in tracked:
+                    hll = self.client_hll.get(hostname)
+                    if hll is None:
+                        hll = self.client_hll[hostname] = HyperLogLog(SKETCH_HLL_PRECISION)
+                    hll.add(client)
+
+    def summary(self, n):
+        with self.lock:
+            result = {name: sketch.top(n) for name, sketch in self.top.items()}
+            result["day"] = self.day.isoformat()
+            result["distinct_clients"] = self.all_clients.count()
+            result["distinct_clients_per_hostname"] = {hostname: self.client_hll[hostname].count() for hostname, count, error in result["hostnames"] if hostname in self.client_hll}
+            return result
+
+    def distinct_clients(self, hostname):
+        with self.lock:
+            hll = self.client_hll.get(hostname)
+            return hll.count() if hll is not None else None
+
+    def save(self, path):
+        with self.lock:
+            data = {
+                "day": self.day.isoformat(),
+                "top": {name: sketch.to_json() for name, sketch in self.top.items()},
+                "client_hll": {hostname: hll.to_json() for hostname, hll in self.client_hll.items()},
+                "all_clients": self.all_clients.to_json()
+            }
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+    # Pick up the checkpoint in path if it's from today
+    def load(self, path):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        if data.get("day") != self.day.isoformat():
+            return
+
+        with self.lock:
+            self.top = {name: SpaceSaving.from_json(SKETCH_TOP_K, data["top"].get(name, [])) for name in self.top}
+            self.client_hll = {hostname: HyperLogLog.from_json(SKETCH_HLL_PRECISION, registers) for hostname, registers in data["client_hll"].items()}
+            self.all_clients = HyperLogLog.from_json(SKETCH_HLL_PRECISION, data["all_clients"])
+
+sketches = Sketches() if SKETCHES else None
+
+def save_sketches():
+    try:
+        sketches.save(SKETCH_FILE)
+    except OSError as e:
+        print(f"Saving the sketches failed: {e}", file=sys.stderr)
+
+# Serve the sketches as JSON on SKETCH_HTTP from a background thread
+#   /                                  everything, ?n= sets how many items (default 25)
+#   /top/hostnames, /top/blocked, /top/clients   [item, count, possible overcount] lists, ?n= as above
+#   /distinct-clients?hostname=NAME    estimated distinct clients of a tracked hostname
+def serve_sketches():
+    import http.server
+    import urllib.parse
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            query = urllib.parse.parse_qs(url.query)
+
+            try:
+                n = int(query.get("n", ["25"])[0])
+            except ValueError:
+                n = 25
+
+            if url.path == "/":
+                body = sketches.summary(n)
+            elif url.path.startswith("/top/") and url.path[5:] in sketches.top:
+                body = sketches.summary(n)[url.path[5:]]
+            elif url.path == "/distinct-clients" and "hostname" in query:
+                hostname = query["hostname"][0]
+                body = {"hostname": hostname, "distinct_clients": sketches.distinct_clients(hostname)}
+            else:
+                self.send_error(404)
+                return
+
+            data = json_dumps(body).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(SKETCH_HTTP, Handler)
+    threading.Thread(target=server.serve_forever, name="sketches", daemon=True).start()
+
+    return server
+
+# One field of an answer line with Python's backslash escapes for backslashes, tabs, line breaks and other control
+# characters so they can't break up the line, and for anything outside ASCII as the armscii8 column can't hold it
+def escape_field(value):
+    value = str(value)
+    if value.isascii() and value.isprintable() and "\\" not in value:
+        return value
+
+    return value.encode("unicode_escape").decode()
+
+# Answers are kept as JSON in the legacy schema, the normalized schema stores one "type<TAB>value<TAB>ttl" line per
+# answer which is a fraction of the size and still readable from SQL
+def encode_answers(answers):
+    if DB_SCHEMA == "normalized":
+        return "\n".join(f"{escape_field(a.get('type', ''))}\t{escape_field(a.get('value', ''))}\t{escape_field(a.get('ttl', ''))}" for a in answers)
+
+    return json_dumps(answers)
+
+# Parse the RFC 3339 timestamps AdGuard Home writes, eg 2025-01-02T03:04:05.123456789+11:00, by slicing rather than
+# going through dateutil. Nanoseconds are cut to microseconds, anything that doesn't look like that goes to dateutil
+def parse_rfc3339(ts):
+    if ts[-1] == "Z":
+        offset, body = "Z", ts[:-1]
+    else:
+        offset, body = ts[-6:], ts[:-6]
+
+    tz = offset_tz.get(offset)
+
+    try:
+        if tz is None:
+            if offset[0] not in "+-" or offset[3] != ":":
+                return parser.isoparse(ts)
+
+            delta = datetime.timedelta(hours=int(offset[1:3]), minutes=int(offset[4:6]))
+            tz = offset_tz[offset] = datetime.timezone(-delta if offset[0] == "-" else delta)
+
+        if len(body) == 19:
+            microsecond = 0
+        elif body[19] == ".":
+            microsecond = int(body[20:26].ljust(6, "0"))
+        else:
+            return parser.isoparse(ts)
+
+        return datetime.datetime(
+            int(body[0:4]), int(body[5:7]), int(body[8:10]),
+            int(body[11:13]), int(body[14:16]), int(body[17:19]),
+            microsecond, tz
+        )
+    except (ValueError, IndexError):
+        return parser.isoparse(ts)
+
+# Turn a querylog entry into a querylog row, returns None for entries that aren't stored. dt is the already parsed
+# time of the entry and source the name of the instance it came from
+def entry_to_row(e, dt, source=""):
+    answers = e.get("answer")
+
+    if not answers:
+        return None
+
+    question = e.get("question") or {}
+    rule = e.get("rule")
+    ruleid = 0
+
+    blocked = 0
+    if rule:
+        rules = e.get("rules", [])
+        if rules:
+            ruleid = int(rules[0].get("filter_list_id", 0))
+
+        if not rule.startswith("@@"):
+            blocked = 1
+
+    row = (
+        dt.astimezone(local_tz),
+        question.get("name"),
+        e.get("client"),
+        question.get("type"),
+        encode_answers(answers),
+        blocked,
+        rule,
+        ruleid
+    )
+
+    return row + (source,) if DB_SOURCES else row
+
+# Go through one page of entries, only entries newer than last_dt are turned into rows. Returns the rows, the number
+# of new entries, the oldest entry's time as (string, datetime) for the paging cursor and the same for the newest new
+# entry for the watermark
+def parse_page(data, last_dt, source=""):
+    rows = []
+    new_entries = 0
+    oldest = oldest_dt = None
+    newest = newest_dt = None
+
+    for e in data:
+        ts = e.get("time")
+        if not ts:
+            continue
+
+        dt = parse_rfc3339(ts)
+
+        # Every entry moves the paging cursor on, even ones that aren't stored
+        if oldest_dt is None or dt < oldest_dt:
+            oldest, oldest_dt = ts, dt
+
+        if last_dt is not None and dt <= last_dt:
+            continue
+
+        new_entries += 1
+
+        if newest_dt is None or dt > newest_dt:
+            newest, newest_dt = ts, dt
+
+        row = entry_to_row(e, dt, source)
+        if row is not None:
+            rows.append(row)
+
+    return rows, new_entries, (oldest, oldest_dt), (newest, newest_dt)
+
+# Prefix for messages about an instance, empty for the one from the constants at the top
+def label(instance):
+    return f"{instance.name}: " if instance.name else ""
+
+# Walk back through the query log of instance until we reach last_ts, returns the new watermark, how many entries were
+# newer than last_ts and whether the newest page came back full of new entries. Timestamps are compared parsed, the
+# offset in them changes with daylight saving so the strings don't always sort
+def poll(db, last_ts, instance):
     before = None
-    newest_seen = last_ts
+    last_dt = parse_rfc3339(last_ts) if last_ts else None
+    newest_seen, newest_dt = last_ts, last_dt
+    key = watermark_key(instance)
+    name = instance.name or "default"
+
+    total_rows = 0
+    new_entries = 0
+    write_time = 0.0
+    first_page_full = False
+    sketch_rows = []
+    today = datetime.date.today()
+
+    # Without MariaDB or a watermark from an earlier run this would walk and spool the whole log
+    if db is None and last_ts is None:
+        print(f"{label(instance)}No watermark known while MariaDB is away, skipping this poll", file=sys.stderr)
+        return last_ts, 0, False
+
+    stats = fetch_stats[instance.name]
+    stats.update(pages=0, time=0.0, bytes=0)
 
     while True:
-        resp = fetch_page(before)
+        resp = fetch_page(instance, before)
         data = resp.get("data", [])
 
         if not data:
             break
 
-        oldest = None
+        rows, page_new_entries, (oldest, oldest_dt), (newest, page_newest_dt) = parse_page(data, last_dt, instance.name)
 
-        with db.cursor() as c:
-            for e in data:
-                answers = e.get("answer", [])
+        if page_newest_dt is not None and (newest_dt is None or page_newest_dt > newest_dt):
+            newest_seen, newest_dt = newest, page_newest_dt
 
-                if not answers:
-                    continue
+        # A full page of nothing but new entries means the log is busy and there's more waiting behind it
+        if before is None:
+            first_page_full = len(data) >= ADGUARD_PAGE_LIMIT and page_new_entries == len(data)
 
-                ts = e.get("time")
-                if not ts:
-                    continue
+        new_entries += page_new_entries
+        before = oldest
 
-                dt_utc = parser.isoparse(ts)
-
-                dt_local = dt_utc.astimezone(local_tz)
-
-                answers_json = json.dumps(answers)
-                hostname = e.get("question").get("name")
-                client = e.get("client")
-                qtype = e.get("question").get("type")
-                reason = e.get("reason")
-                status = e.get("status")
-                rule = e.get("rule")
-                ruleid = 0
-
-                blocked = 0
-                if rule:
-                    rules = e.get("rules", [])
-                    if rules:
-                        ruleid = int(rules[0].get("filter_list_id", 0))
-
-                    if not rule.startswith("@@"):
-                        blocked = 1
-
-                c.execute("""
-                    INSERT IGNORE INTO querylog
-                    (time, hostname, client, qtype, answers, blocked, rule, ruleid)
-                    VALUES (%s,%s,%s,%s,%s,%s,%s,%s)
-                """, (
-                    dt_local,
-                    hostname,
-                    client,
-                    qtype,
-                    answers_json,
-                    blocked,
-                    rule,
-                    ruleid
-                ))
-
-                newest_seen = max(newest_seen, ts)
-                oldest = ts if oldest is None or ts < oldest else oldest
+        # Once we're back to the watermark this is the last page, so it carries the new watermark with it. On the very
+        # first run there is no watermark and the whole log is walked until AdGuard runs out of entries
+        done = oldest is None or (last_dt is not None and oldest_dt <= last_dt)
 
-        before = oldest
+        start = time.monotonic()
+        inserted = store_page(db, rows, {key: newest_seen} if done and newest_seen != last_ts else None)
+        elapsed = time.monotonic() - start
+        write_time += elapsed
+
+        if inserted is not None:
+            total_rows += len(rows)
+            metric_observe("adguard_write_seconds", elapsed, instance=name)
+            metric_add("adguard_rows_inserted_total", inserted, instance=name)
+            metric_add("adguard_rows_ignored_total", len(rows) - inserted, instance=name)
+
+        # Held back until the watermark is stored, a poll that fails part way fetches these pages again next time
+        if sketches is not None:
+            sketch_rows.extend(row for row in rows if row[0].date() == today)
 
-        if oldest <= last_ts:
+        if done:
+            last_ts = newest_seen
             break
 
     if newest_seen != last_ts:
-        set_last_timestamp(db, newest_seen)
+        store_page(db, [], {key: newest_seen})
+
+    if sketch_rows:
+        sketches.update(sketch_rows)
+
+    metric_add("adguard_polls_total", instance=name)
+    metric_observe("adguard_poll_pages", stats["pages"], instance=name)
+    metric_observe("adguard_poll_new_entries", new_entries, instance=name)
+    metric_set("adguard_last_poll_timestamp_seconds", time.time(), instance=name)
+    if newest_dt is not None:
+        metric_set("adguard_watermark_lag_seconds", (datetime.datetime.now(datetime.timezone.utc) - newest_dt).total_seconds(), instance=name)
+
+    if stats["pages"]:
+        print(f"{label(instance)}Fetched {stats['pages']} pages ({stats['bytes']} bytes) in {stats['time']:.2f}s ({stats['time'] * 1000 / stats['pages']:.0f} ms/page)")
+
+    if total_rows:
+        print(f"{label(instance)}Wrote {total_rows} rows in {write_time:.2f}s ({total_rows / max(write_time, 1e-6):.0f} rows/s)")
+
+    return newest_seen, new_entries, first_page_full
+
+# Poll every instance once, each in its own thread with its own connections so the instances are fetched at the same
+# time. The run only ends once every instance is done, a slow router still holds up the next timer run for all of them
+def poll_all(instances):
+    from concurrent.futures import ThreadPoolExecutor
+
+    def poll_instance(instance):
+        db = get_db_or_spool()
+        poll(db, get_last_timestamp(db, instance), instance)
+
+    failed = 0
+
+    with ThreadPoolExecutor(max_workers=len(instances)) as pool:
+        futures = {instance: pool.submit(poll_instance, instance) for instance in instances}
+
+        for instance, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                failed += 1
+                metric_add("adguard_poll_failures_total", instance=instance.name or "default")
+                print(f"{label(instance)}Poll failed: {e}", file=sys.stderr)
+
+    return 1 if failed else 0
+
+# Keep polling instance until stop is set, with the DB and HTTP connections held open and the watermark in memory.
+# The interval drops to DAEMON_MIN_INTERVAL while pages come back full, halves while there's new data and doubles up
+# to DAEMON_MAX_INTERVAL while there isn't
+def poll_loop(instance, stop):
+    last_ts = None
+    loaded = False
+    interval = DAEMON_MIN_INTERVAL
+
+    while not stop.is_set():
+        try:
+            db = get_db_or_spool()
+
+            if not loaded:
+                last_ts = get_last_timestamp(db, instance)
+                # Only once MariaDB has been asked, or state.json had a watermark, otherwise poll() skips
+                loaded = db is not None or last_ts is not None
+
+            last_ts, new_entries, full = poll(db, last_ts, instance)
+
+            if full:
+                interval = DAEMON_MIN_INTERVAL
+            elif new_entries:
+                interval = max(interval / 2, DAEMON_MIN_INTERVAL)
+            else:
+                interval = min(interval * 2, DAEMON_MAX_INTERVAL)
+        except Exception as e:
+            metric_add("adguard_poll_failures_total", instance=instance.name or "default")
+            print(f"{label(instance)}Poll failed: {e}", file=sys.stderr)
+            interval = DAEMON_MAX_INTERVAL
+
+        stop.wait(interval)
+
+# Run a poll_loop() thread per instance, this thread looks after the partitions, replays the spool and checkpoints
+# the sketches. SIGTERM and SIGINT let every instance finish its current poll before exiting
+def daemon(instances):
+    stop = threading.Event()
+
+    def handle_signal(signum, frame):
+        stop.set()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    server = None
+    if sketches is not None:
+        sketches.load(SKETCH_FILE)
+        try:
+            server = serve_sketches()
+        except OSError as e:
+            print(f"Can't serve the sketches on {SKETCH_HTTP[0]}:{SKETCH_HTTP[1]}: {e}", file=sys.stderr)
+
+    metrics_server = None
+    if METRICS_HTTP is not None:
+        try:
+            metrics_server = serve_metrics()
+        except OSError as e:
+            print(f"Can't serve the metrics on {METRICS_HTTP[0]}:{METRICS_HTTP[1]}: {e}", file=sys.stderr)
+
+    threads = [threading.Thread(target=poll_loop, args=(instance, stop), name=instance.name or "poll") for instance in instances]
+    for thread in threads:
+        thread.start()
+
+    partitions_checked = None
+
+    while not stop.is_set():
+        if DB_PARTITIONS and (partitions_checked is None or time.monotonic() - partitions_checked >= PARTITION_CHECK_INTERVAL):
+            partitions_checked = time.monotonic()
+            try:
+                maintain_partitions(get_db())
+            except pymysql.MySQLError as e:
+                print(f"Partition maintenance failed: {e}", file=sys.stderr)
+
+        if SPOOL_DIR is not None:
+            try:
+                replay_spool(get_db())
+            except pymysql.MySQLError as e:
+                print(f"Replaying the spool failed: {e}", file=sys.stderr)
+
+        if sketches is not None:
+            save_sketches()
+
+        if METRICS_TEXTFILE is not None:
+            write_metrics()
+
+        stop.wait(DAEMON_MAX_INTERVAL)
+
+    for thread in threads:
+        thread.join()
+
+    if sketches is not None:
+        save_sketches()
+    if server is not None:
+        server.shutdown()
+
+    if METRICS_TEXTFILE is not None:
+        write_metrics()
+    if metrics_server is not None:
+        metrics_server.shutdown()
+
+# Fetch everything between shard_start and shard_end by walking back from shard_end with older_than, only rows inside
+# the shard are kept so neighbouring shards don't overlap. Progress is stored under key as the older_than cursor, or
+# "done", in the same transaction as each page so an interrupted backfill picks up where it left off
+def backfill_shard(instance, shard_start, shard_end, key):
+    db = get_db()
+
+    progress = get_state(db, key)
+    if progress == "done":
+        return 0
+
+    before = progress or shard_end.isoformat()
+    total_rows = 0
+
+    while True:
+        data = fetch_page(instance, before).get("data", [])
+
+        oldest = None
+        oldest_dt = None
+        rows = []
+
+        for e in data:
+            ts = e.get("time")
+            if not ts:
+                continue
+
+            dt = parse_rfc3339(ts)
+            if oldest_dt is None or dt < oldest_dt:
+                oldest, oldest_dt = ts, dt
+
+            if not shard_start <= dt < shard_end:
+                continue
+
+            row = entry_to_row(e, dt, instance.name)
+            if row is not None:
+                rows.append(row)
+
+        done = oldest is None or oldest_dt < shard_start
+
+        write_page(db, rows, {key: "done" if done else oldest})
+        total_rows += len(rows)
+
+        if done:
+            return total_rows
+
+        before = oldest
+
+# Split start to end into shards of shard_hours and fetch them from instance with a pool of workers
+def backfill(instance, start, end, shard_hours, workers):
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    shards = []
+    shard_start = start
+    while shard_start < end:
+        shard_end = min(shard_start + datetime.timedelta(hours=shard_hours), end)
+        # state.k is only 32 characters (64 with DB_SOURCES), epoch seconds keep the key short and unique per shard
+        prefix = f"bf:{instance.name}:" if instance.name else "bf:"
+        shards.append((instance, shard_start, shard_end, f"{prefix}{int(shard_start.timestamp())}-{int(shard_end.timestamp())}"))
+        shard_start = shard_end
+
+    stats = fetch_stats[instance.name]
+    stats.update(pages=0, time=0.0, bytes=0)
+    started = time.monotonic()
+    total_rows = 0
+    failed = 0
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(backfill_shard, *shard): shard for shard in shards}
+
+        for future in as_completed(futures):
+            instance, shard_start, shard_end, key = futures[future]
+            try:
+                rows = future.result()
+                total_rows += rows
+                print(f"{label(instance)}Shard {shard_start.isoformat()} - {shard_end.isoformat()}: {rows} rows")
+            except Exception as e:
+                failed += 1
+                print(f"{label(instance)}Shard {shard_start.isoformat()} - {shard_end.isoformat()} failed: {e}", file=sys.stderr)
+
+    elapsed = time.monotonic() - started
+    print(f"{label(instance)}Backfilled {total_rows} rows from {len(shards) - failed}/{len(shards)} shards and {stats['pages']} pages in {elapsed:.2f}s ({total_rows / max(elapsed, 1e-6):.0f} rows/s)")
+
+    return 1 if failed else 0
+
+# Parse a date or date and time given on the commandline, naive values are taken as local time
+def parse_time_arg(value):
+    dt = parser.isoparse(value)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=local_tz)
+    return dt
+
+def main():
+    argparser = argparse.ArgumentParser(description="Download query logs from AdGuard Home into MariaDB.")
+    argparser.add_argument("--daemon", action="store_true", help="Keep running and poll on an adaptive interval instead of exiting after one poll")
+    argparser.add_argument("--backfill", nargs=2, metavar=("START", "END"), type=parse_time_arg, help="Fetch everything between START and END, eg 2025-01-01 2025-02-01T12:00, and exit")
+    argparser.add_argument("--shard-hours", type=float, default=1, help="Size of each backfill shard in hours")
+    argparser.add_argument("--workers", type=int, default=4, help="Number of shards fetched at the same time")
+    argparser.add_argument("--config", metavar="FILE", help="File listing the AdGuard Home instances to download from, see ADGUARD_PASS above")
+    argparser.add_argument("--instance", metavar="NAME", help="Instance from --config to backfill, defaults to the first one")
+    argparser.add_argument("--replay", action="store_true", help="Load everything in SPOOL_DIR into MariaDB and exit")
+    args = argparser.parse_args()
+
+    if args.config and not DB_SOURCES:
+        argparser.error("--config needs DB_SOURCES = True and adguard-log-downloader-sources.sql")
+
+    instances = load_instances(args.config)
+
+    if args.backfill:
+        start, end = args.backfill
+        if start >= end:
+            argparser.error("--backfill START has to be before END")
+
+        instance = instances[0]
+        if args.instance:
+            instance = next((i for i in instances if i.name == args.instance), None)
+            if instance is None:
+                argparser.error(f"--instance {args.instance} isn't in {args.config}")
+
+        sys.exit(backfill(instance, start, end, args.shard_hours, max(args.workers, 1)))
+
+    if args.replay:
+        if SPOOL_DIR is None:
+            argparser.error("--replay needs SPOOL_DIR")
+
+        db = db_connect()
+        try:
+            if not replay_spool(db):
+                print(f"Nothing spooled in {SPOOL_DIR}")
+        finally:
+            db.close()
+        sys.exit(0)
+
+    if METRICS_TEXTFILE is not None:
+        load_metrics()
+
+    if args.daemon:
+        daemon(instances)
+        sys.exit(0)
+
+    # With a spool the run still goes ahead while MariaDB is away
+    db = get_db_or_spool()
+
+    if db is not None:
+        if DB_PARTITIONS:
+            try:
+                maintain_partitions(db)
+            except pymysql.MySQLError as e:
+                print(f"Partition maintenance failed: {e}", file=sys.stderr)
+
+        if SPOOL_DIR is not None:
+            try:
+                replay_spool(db)
+            except pymysql.MySQLError as e:
+                print(f"Replaying the spool failed: {e}", file=sys.stderr)
+
+    if sketches is not None:
+        sketches.load(SKETCH_FILE)
+
+    status = poll_all(instances)
+
+    if sketches is not None:
+        save_sketches()
+    if METRICS_TEXTFILE is not None:
+        write_metrics()
 
-    db.close()
+    sys.exit(status)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+
+#
+# Measures how many querylog entries per second adguard-log-downloader.py turns into rows, from the raw page bytes to
+# the rows handed to MariaDB, with the original per entry code (dateutil, json.dumps, string compares) and with the
+# current parse_page(). No database or router is needed, the pages come from files.
+#
+# Record some pages from the router first, the settings are read from adguard-log-downloader.py
+#   ./adguard-parse-benchmark.py --record pages --pages 20
+# and then
+#   ./adguard-parse-benchmark.py pages/*.json
+#
+# Without any files a synthetic page is used instead.
+#
+
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import time
+
+from dateutil import parser
+
+from adguard_common import load_downloader
+
+# Nothing is configurable below this line
+
+downloader = load_downloader()
+
+# The loop from before parse_page(), kept here as the baseline
+def original_parse_page(data, last_ts):
+    rows = []
+    oldest = None
+    newest_seen = last_ts
+
+    for e in data:
+        ts = e.get("time")
+        if not ts:
+            continue
+
+        oldest = ts if oldest is None or ts < oldest else oldest
+
+        answers = e.get("answer", [])
+        if not answers:
+            continue
+
+        dt_local = parser.isoparse(ts).astimezone(downloader.local_tz)
+        answers_data = json.dumps(answers)
+        hostname = e.get("question").get("name")
+        client = e.get("client")
+        qtype = e.get("question").get("type")
+        rule = e.get("rule")
+        ruleid = 0
+
+        blocked = 0
+        if rule:
+            rules = e.get("rules", [])
+            if rules:
+                ruleid = int(rules[0].get("filter_list_id", 0))
+
+            if not rule.startswith("@@"):
+                blocked = 1
+
+        rows.append((dt_local, hostname, client, qtype, answers_data, blocked, rule, ruleid))
+        newest_seen = ts if newest_seen is None else max(newest_seen, ts)
+
+    return rows, oldest, newest_seen
+
+def synthetic_page(entries):
+    rng = random.Random(1)
+    tz = datetime.timezone(datetime.timedelta(hours=11))
+    now = datetime.datetime(2025, 1, 2, 12, 0, 0, tzinfo=tz)
+    data = []
+
+    for i in range(entries):
+        dt = now - datetime.timedelta(milliseconds=i * 250 + rng.randrange(250))
+        host = f"host{rng.randrange(2000)}.example.com"
+        blocked = rng.random() < 0.1
+
+        e = {
+            "answer": [{"type": "A", "value": f"192.0.2.{rng.randrange(256)}", "ttl": rng.randrange(3600)}],
+            "client": f"192.168.1.{rng.randrange(2, 60)}",
+            "elapsedMs": "0.5",
+            "question": {"class": "IN", "name": host, "type": rng.choice(["A", "AAAA", "HTTPS"])},
+            "reason": "FilteredBlackList" if blocked else "NotFilteredNotFound",
+            "status": "NOERROR",
+            "time": dt.isoformat(timespec="microseconds")[:26] + f"{rng.randrange(1000):03d}" + dt.isoformat()[-6:],
+            "upstream": "https://dns.example/dns-query"
+        }
+
+        if blocked:
+            e["rule"] = f"||{host}^"
+            e["rules"] = [{"filter_list_id": 1, "text": f"||{host}^"}]
+        elif rng.random() < 0.02:
+            # TXT records can hold anything, these have to reach the armscii8 database escaped
+            e["question"]["type"] = "TXT"
+            e["answer"] = [{"type": "TXT", "value": rng.choice(["caf\u00e9 \u00fcber na\u00efve", "\u6d4b\u8bd5", "emoji \U0001f600"]), "ttl": 300}]
+
+        data.append(e)
+
+    return json.dumps({"data": data}).encode()
+
+def record(directory, pages):
+    os.makedirs(directory, exist_ok=True)
+    instance = downloader.load_instances()[0]
+    before = None
+
+    for n in range(pages):
+        r = downloader.get_session(instance).get(
+            instance.url,
+            params={"limit": downloader.ADGUARD_PAGE_LIMIT, "response_status": "all", **({"older_than": before} if before else {})},
+            timeout=downloader.ADGUARD_TIMEOUT
+        )
+        r.raise_for_status()
+
+        path = os.path.join(directory, f"page-{n:04d}.json")
+        with open(path, "wb") as f:
+            f.write(r.content)
+
+        data = json.loads(r.content).get("data", [])
+        print(f"{path}: {len(data)} entries")
+
+        if not data:
+            break
+
+        before = min((e["time"] for e in data if e.get("time")), key=downloader.parse_rfc3339)
+
+def run(name, bodies, entries, parse, seconds):
+    runs = 0
+    started = time.perf_counter()
+
+    while True:
+        for body in bodies:
+            parse(body)
+        runs += 1
+
+        elapsed = time.perf_counter() - started
+        if elapsed >= seconds:
+            break
+
+    print(f"{name:<32} {entries * runs / elapsed:>12,.0f} entries/s")
+
+def main():
+    argparser = argparse.ArgumentParser(description="Benchmark turning querylog pages into rows.")
+    argparser.add_argument("pages", nargs="*", help="Recorded /control/querylog responses")
+    argparser.add_argument("--record", metavar="DIR", help="Save pages from the router into DIR instead of benchmarking")
+    argparser.add_argument("--pages", type=int, default=10, help="Number of pages to record")
+    argparser.add_argument("--entries", type=int, default=5000, help="Entries in the synthetic page when no pages are given")
+    argparser.add_argument("--seconds", type=float, default=3, help="Time spent on each variant")
+    args = argparser.parse_args()
+
+    if args.record:
+        record(args.record, args.pages)
+        return
+
+    bodies = []
+    for path in args.pages:
+        with open(path, "rb") as f:
+            bodies.append(f.read())
+
+    if not bodies:
+        bodies.append(synthetic_page(args.entries))
+
+    times = sorted(downloader.parse_rfc3339(e["time"]) for body in bodies for e in json.loads(body).get("data", []) if e.get("time"))
+    entries = len(times)
+    print(f"{len(bodies)} pages, {entries} entries")
+
+    if not entries:
+        return
+
+    # Half the entries at or below the watermark, as when a poll reaches the last one
+    watermark = times[len(times) // 2]
+    watermark_ts = watermark.isoformat()
+
+    run("original", bodies, entries, lambda body: original_parse_page(json.loads(body)["data"], None), args.seconds)
+    run("original, half below watermark", bodies, entries, lambda body: original_parse_page(json.loads(body)["data"], watermark_ts), args.seconds)
+
+    decoders = [("json", json.loads, downloader.json_encode)]
+    if downloader.orjson is not None:
+        decoders.append(("orjson", downloader.orjson.loads, downloader.json_dumps))
+
+    for name, loads, dumps in decoders:
+        downloader.json_dumps = dumps
+
+        # Anything but ASCII would be rejected by MariaDB and stall the poll on that page for good
+        for body in bodies:
+            rows = downloader.parse_page(loads(body)["data"], None)[0]
+            if not all(row[4].isascii() for row in rows):
+                sys.exit(f"parse_page ({name}) produced answers that aren't ASCII")
+
+        run(f"parse_page ({name})", bodies, entries, lambda body: downloader.parse_page(loads(body)["data"], None), args.seconds)
+        run(f"parse_page ({name}), half below", bodies, entries, lambda body: downloader.parse_page(loads(body)["data"], watermark), args.seconds)
+
+if __name__ == "__main__":
+    main()
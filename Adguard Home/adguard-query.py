@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+
+#
+# Answers the common reports from common-sql-queries-on-adguard-dns-query-data.md from the querylog_rollup table
+# instead of scanning querylog, and rebuilds the rollups from the raw rows when asked to.
+#
+# The database settings are read from adguard-log-downloader.py in the same directory.
+#
+
+import argparse
+import datetime
+import sys
+import time
+
+from adguard_common import load_downloader
+
+# Nothing is configurable below this line
+
+REPORTS = {
+    "top-blocked": ("hostname", 1, "Blocked hostnames by number of queries"),
+    "top-hostnames": ("hostname", None, "Hostnames by number of queries"),
+    "top-clients": ("client", None, "Clients by number of queries"),
+    "qtypes": ("qtype", None, "Queries by query type"),
+    "filter-lists": ("ruleid", 1, "Blocked queries by filter list id")
+}
+
+downloader = load_downloader()
+
+def parse_time_arg(value):
+    return datetime.datetime.fromisoformat(value)
+
+# Whole hours can come from the hourly rollups, anything else needs the per minute ones
+def pick_granularity(since, until):
+    for dt in (since, until):
+        if dt is not None and (dt.minute or dt.second or dt.microsecond):
+            return "minute"
+    return "hour"
+
+def time_filter(since, until):
+    where = ""
+    params = []
+
+    if since is not None:
+        where += " AND bucket >= %s"
+        params.append(since)
+
+    if until is not None:
+        where += " AND bucket < %s"
+        params.append(until)
+
+    return where, params
+
+def report_span(db, since, until):
+    where, params = time_filter(since, until)
+
+    with db.cursor() as c:
+        c.execute(f"SELECT MIN(bucket), MAX(bucket) FROM querylog_rollup WHERE granularity='minute'{where}", params)
+        first, last = c.fetchone()
+
+    if first is None:
+        print("No data")
+        return
+
+    diff = int((last + datetime.timedelta(minutes=1) - first).total_seconds())
+    print(f"{first} - {last + datetime.timedelta(minutes=1)}: {diff // 86400} days, {diff % 86400 // 3600} hours, {diff % 3600 // 60} minutes")
+
+def report_top(db, name, since, until, limit):
+    dim, blocked, title = REPORTS[name]
+    where, params = time_filter(since, until)
+
+    if blocked is not None:
+        where += " AND blocked = %s"
+        params.append(blocked)
+
+    with db.cursor() as c:
+        c.execute(f"""
+            SELECT value, SUM(queries) AS total
+            FROM querylog_rollup
+            WHERE granularity = %s AND dim = %s{where}
+            GROUP BY value
+            ORDER BY total DESC
+            LIMIT %s
+        """, [pick_granularity(since, until), dim] + params + [limit])
+        rows = c.fetchall()
+
+    print(title)
+    for value, total in rows:
+        print(f"{int(total):>12}  {value}")
+
+# Recalculate the rollups a day at a time from the raw rows, each day in its own transaction
+def rebuild(db, since, until):
+    with db.cursor() as c:
+        c.execute("SELECT MIN(`time`), MAX(`time`) FROM querylog")
+        first, last = c.fetchone()
+
+    if first is None:
+        print("querylog is empty")
+        return
+
+    start = (since or first).replace(hour=0, minute=0, second=0, microsecond=0)
+    end = until or last.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+
+    while start < end:
+        day_end = min(start + datetime.timedelta(days=1), end)
+
+        started = time.monotonic()
+        db.begin()
+        try:
+            with db.cursor() as c:
+                downloader.update_rollups(c, start, day_end)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+        print(f"Rebuilt {start} - {day_end} in {time.monotonic() - started:.2f}s")
+        start = day_end
+
+def main():
+    argparser = argparse.ArgumentParser(description="Query the AdGuard Home query log rollups.")
+    argparser.add_argument("report", choices=["span", "rebuild"] + list(REPORTS), help="Report to run, or rebuild to recalculate the rollups from querylog")
+    argparser.add_argument("--since", type=parse_time_arg, default=None, help="Only include data from this local time on, eg 2025-01-01 or 2025-01-01T12:30")
+    argparser.add_argument("--until", type=parse_time_arg, default=None, help="Only include data before this local time")
+    argparser.add_argument("-n", "--limit", type=int, default=25, help="Number of rows to show")
+    args = argparser.parse_args()
+
+    db = downloader.db_connect()
+    started = time.monotonic()
+
+    try:
+        if args.report == "rebuild":
+            rebuild(db, args.since, args.until)
+        elif args.report == "span":
+            report_span(db, args.since, args.until)
+        else:
+            report_top(db, args.report, args.since, args.until, args.limit)
+    finally:
+        db.close()
+
+    print(f"({(time.monotonic() - started) * 1000:.1f} ms)", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
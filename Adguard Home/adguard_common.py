@@ -0,0 +1,14 @@
+#
+# Shared by the scripts next to adguard-log-downloader.py, which use its settings and functions. Its name has dashes
+# in it so it can't be imported the usual way.
+#
+
+import importlib.util
+import os
+
+def load_downloader():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "adguard-log-downloader.py")
+    spec = importlib.util.spec_from_file_location("adguard_log_downloader", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
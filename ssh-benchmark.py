@@ -0,0 +1,288 @@
+#!/usr/bin/python3
+
+# Benchmarks for ssh.py, run against local stand-ins so the numbers only reflect the wrapper and not the network or
+# the remote end.
+#
+#   throughput : how fast data gets through the wrapper when the session is relayed through pexpect and when ssh is
+#                exec'd in place, using a stand-in ssh that writes a fixed amount of data to stdout
+#   startup    : time to first prompt for a literal IP and for a hostname with a cold and a warm DNS cache, using a
+#                stub DNS server and a stand-in ssh that prints a prompt, along with ssh.py's own phase timings
+
+import argparse
+import json
+import os
+import pty
+import select
+import socket
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Nothing needs configuring below this line
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+ssh_py = os.path.join(script_dir, "ssh.py")
+
+# What the stand-in ssh prints once it's "connected"
+prompt = b"benchmark$ "
+
+# Address the stub DNS server hands out for every A query, a LAN address so no stable IP is needed
+stub_address = "192.0.2.10"
+
+parser = argparse.ArgumentParser(description="Benchmarks for ssh.py using local stand-ins for ssh and DNS.")
+subparsers = parser.add_subparsers(dest="suite", required=True)
+
+throughput_parser = subparsers.add_parser("throughput", help="Compare transfer throughput of ssh.py in pexpect and exec mode")
+throughput_parser.add_argument("-s", "--size", type=int, default=256, help="Megabytes written by the stand-in ssh per run")
+throughput_parser.add_argument("-r", "--runs", type=int, default=3, help="Number of runs per mode")
+throughput_parser.add_argument("-t", "--target", default="127.0.0.1", help="Target passed to ssh.py, a literal LAN IP avoids any DNS")
+
+startup_parser = subparsers.add_parser("startup", help="Measure time to first prompt and the time spent in each startup phase")
+startup_parser.add_argument("-r", "--runs", type=int, default=10, help="Number of runs per scenario")
+startup_parser.add_argument("--pexpect", action="store_true", help="Relay the session through pexpect instead of using --exec")
+
+args = parser.parse_args()
+
+# Write a fake ssh that ignores its arguments and dumps size bytes on stdout
+def make_fake_ssh(tmp_dir, size):
+
+    fake_ssh = os.path.join(tmp_dir, "ssh")
+    with open(fake_ssh, "w") as f:
+        f.write(f"#!/bin/sh\nexec head -c {size} /dev/zero\n")
+    os.chmod(fake_ssh, 0o755)
+
+    return fake_ssh
+
+# Run cmd with a pty as its terminal, pexpect's interact() needs one, and count the bytes that come out
+def run_on_pty(cmd, env):
+
+    master, slave = pty.openpty()
+
+    start = time.monotonic()
+    proc = subprocess.Popen(cmd, stdin=slave, stdout=slave, stderr=subprocess.DEVNULL, env=env, close_fds=True)
+    os.close(slave)
+
+    total = 0
+    while True:
+        ready, _, _ = select.select([master], [], [], 1)
+        if not ready:
+            if proc.poll() is not None:
+                break
+            continue
+
+        try:
+            chunk = os.read(master, 65536)
+        except OSError:
+            break
+
+        if not chunk:
+            break
+        total += len(chunk)
+
+    proc.wait()
+    os.close(master)
+
+    return total, time.monotonic() - start
+
+# Run cmd with stdout going to a pipe, which is only possible in exec mode
+def run_on_pipe(cmd, env):
+
+    start = time.monotonic()
+    proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=env)
+
+    total = 0
+    while True:
+        chunk = proc.stdout.read(1 << 20)
+        if not chunk:
+            break
+        total += len(chunk)
+
+    proc.wait()
+
+    return total, time.monotonic() - start
+
+# Write a fake ssh that prints a prompt and exits
+def make_prompt_ssh(tmp_dir):
+
+    fake_ssh = os.path.join(tmp_dir, "ssh-prompt")
+    with open(fake_ssh, "w") as f:
+        f.write(f"#!/bin/sh\nprintf '{prompt.decode()}'\n")
+    os.chmod(fake_ssh, 0o755)
+
+    return fake_ssh
+
+# Build a reply to a DNS query, A questions get stub_address with a 5 minute TTL and everything else an empty answer
+def stub_dns_reply(query):
+
+    qid, flags, qdcount = struct.unpack_from("!HHH", query)
+
+    # Walk past the question name to find the type
+    offset = 12
+    while query[offset]:
+        offset += query[offset] + 1
+    qtype = struct.unpack_from("!H", query, offset + 1)[0]
+    question = query[12:offset + 5]
+
+    answers = b""
+    if qtype == 1:
+        answers = struct.pack("!HHHLH", 0xC00C, 1, 1, 300, 4) + socket.inet_aton(stub_address)
+
+    return struct.pack("!HHHHHH", qid, 0x8180 | (flags & 0x0100), 1, 1 if answers else 0, 0, 0) + question + answers
+
+# Tiny UDP DNS server on localhost, runs until the process exits
+def start_stub_dns():
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+
+    def serve():
+        while True:
+            query, peer = sock.recvfrom(512)
+            try:
+                sock.sendto(stub_dns_reply(query), peer)
+            except (IndexError, struct.error):
+                pass
+
+    threading.Thread(target=serve, daemon=True).start()
+
+    return "127.0.0.1:%d" % sock.getsockname()[1]
+
+# Seed a cache directory with a dependency stamp so ssh.py doesn't go off and probe or install packages
+def make_cache_dir(tmp_dir, name):
+
+    cache_dir = os.path.join(tmp_dir, name)
+    os.makedirs(os.path.join(cache_dir, "ssh.py"), exist_ok=True)
+
+    try:
+        mtime = os.stat("/var/lib/dpkg/status").st_mtime_ns
+    except OSError:
+        mtime = 0
+
+    with open(os.path.join(cache_dir, "ssh.py", "deps.stamp"), "w") as f:
+        json.dump({"mtime": mtime, "versions": {"python3-dnspython": "benchmark", "python3-pexpect": "benchmark"}}, f)
+
+    return cache_dir
+
+# Start cmd on a pty and return how long it took for the prompt to show up
+def time_to_prompt(cmd, env):
+
+    master, slave = pty.openpty()
+
+    start = time.monotonic()
+    proc = subprocess.Popen(cmd, stdin=slave, stdout=slave, stderr=subprocess.DEVNULL, env=env, close_fds=True)
+    os.close(slave)
+
+    output = b""
+    elapsed = None
+    while elapsed is None:
+        ready, _, _ = select.select([master], [], [], 10)
+        if not ready:
+            break
+
+        try:
+            chunk = os.read(master, 65536)
+        except OSError:
+            break
+
+        if not chunk:
+            break
+
+        output += chunk
+        if prompt in output:
+            elapsed = time.monotonic() - start
+
+    proc.wait()
+    os.close(master)
+
+    if elapsed is None:
+        sys.exit(f"No prompt seen from {cmd}, output was:\n{output.decode(errors='replace')}")
+
+    return elapsed
+
+def report(name, results):
+
+    best_bytes, best_time = min(results, key=lambda r: r[1])
+    print(f"{name:<14} {best_bytes / best_time / 1e6:10.1f} MB/s   best of {len(results)}: {best_time:.3f}s for {best_bytes} bytes")
+
+def run_throughput():
+
+    size = args.size * 1024 * 1024
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env = dict(os.environ)
+        env["SSH_PY_SSH"] = make_fake_ssh(tmp_dir, size)
+        env["XDG_CACHE_HOME"] = make_cache_dir(tmp_dir, "cache")
+
+        modes = [
+            ("pexpect (pty)", run_on_pty, [sys.executable, ssh_py, args.target]),
+            ("exec (pty)", run_on_pty, [sys.executable, ssh_py, "--exec", args.target]),
+            ("exec (pipe)", run_on_pipe, [sys.executable, ssh_py, "--exec", args.target]),
+        ]
+
+        failed = False
+
+        for name, runner, cmd in modes:
+            results = [runner(cmd, env) for _ in range(args.runs)]
+            report(name, results)
+
+            # Anything the wrapper prints on stdout would end up in the middle of a piped transfer and anything it
+            # doesn't pass on is lost, either way it's noted under the mode and the other modes still run
+            wrong = [total for total, elapsed in results if total != size]
+            if wrong:
+                print(f"{'':<14} {len(wrong)} of {len(results)} runs got {', '.join(map(str, sorted(set(wrong))))} bytes, the stand-in ssh wrote {size}")
+                failed = True
+
+        if failed:
+            sys.exit(1)
+
+def run_startup():
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env = dict(os.environ)
+        env["SSH_PY_SSH"] = make_prompt_ssh(tmp_dir)
+        env["SSH_PY_NAMESERVER"] = start_stub_dns()
+
+        mode = [] if args.pexpect else ["--exec"]
+        warm_cache = make_cache_dir(tmp_dir, "warm")
+
+        scenarios = [
+            ("literal IP", "127.0.0.1", lambda run: warm_cache),
+            ("cold DNS", "bench.example", lambda run: make_cache_dir(tmp_dir, f"cold-{run}")),
+            ("warm DNS", "bench.example", lambda run: warm_cache),
+        ]
+
+        for name, target, cache_dir in scenarios:
+            profile_file = os.path.join(tmp_dir, f"{name}.jsonl")
+            times = []
+
+            for run in range(args.runs):
+                env["XDG_CACHE_HOME"] = cache_dir(run)
+                times.append(time_to_prompt([sys.executable, ssh_py] + mode + ["--profile-file", profile_file, target], env) * 1000)
+
+            # The first warm run fills the cache, so leave it out
+            if name == "warm DNS" and len(times) > 1:
+                times = times[1:]
+
+            phases = {}
+            with open(profile_file) as f:
+                for line in f:
+                    for phase, ms in json.loads(line)["phases"].items():
+                        phases.setdefault(phase, []).append(ms)
+
+            print(f"{name:<12} first prompt: median {statistics.median(times):8.2f} ms   min {min(times):8.2f} ms   max {max(times):8.2f} ms")
+            for phase, values in phases.items():
+                print(f"    {phase:<12} median {statistics.median(values):8.3f} ms")
+
+def main():
+
+    if args.suite == "throughput":
+        run_throughput()
+    else:
+        run_startup()
+
+if __name__ == "__main__":
+    main()
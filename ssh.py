@@ -8,163 +8,1134 @@
 #  /usr/bin/ssh.py "$@"
 # }
 
-import subprocess
+# Optionally copy ssh-source-agent.service to ~/.config/systemd/user/ and enable it with
+# systemctl --user enable --now ssh-source-agent.service
+# to keep the default interface and stable IP in memory instead of looking them up on every run.
+
+import time
 
-# Check if all nessecary packages are installed and install the missing ones
-try:
-    packages = ["python3-netifaces", "python3-dnspython", "python3-pexpect", "python3-psutil"]
-    missing = [pkg for pkg in packages if subprocess.run(["dpkg", "-s", pkg], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode != 0]
-    if missing:
-        subprocess.run(["apt", "-y", "install"] + missing, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-except Exception as e:
-    sys.exit(f"Exception: {str(e)}")
+# Taken before anything else is imported so --profile can report how long the imports took
+profile_start = time.monotonic()
 
 import argparse
-import dns.resolver
+import collections
+import contextlib
 import ipaddress
-import netifaces
+import json
 import os
-import pexpect
-import psutil
 import re
 import signal
+import socket
+import struct
+import subprocess
 import sys
 
+# The heavier modules (dns.resolver and pexpect) are imported inside the functions that use them
+# so a connection to a literal IP never pays for loading dnspython and so on.
+
 debug = 1
 
 child = None
 
+# The real ssh binary, can be overridden from the environment to point at a stand-in for benchmarking
+ssh_binary = os.environ.get("SSH_PY_SSH", "/usr/bin/ssh")
+
 # Load and parse commandline arguments
 parser = argparse.ArgumentParser(description="Wrapper around ssh that ensures a host/IP is provided.")
 parser.add_argument("-4", dest="ipv4", action="store_true", help="Force IPv4 connection")
 parser.add_argument("-6", dest="ipv6", action="store_true", help="Force IPv6 connection")
 parser.add_argument("-p", "--port", default=None, help="Specify the SSH port to connect to")
 parser.add_argument("-i", "--interface", default=None, help="Specify network interface")
+parser.add_argument("--exec", dest="exec_ssh", action="store_true", help="Replace this process with ssh instead of relaying the session through pexpect")
+parser.add_argument("--race", action="store_true", help="Race connections to all addresses of the host and give ssh the first one to answer")
+parser.add_argument("--hosts", default=None, help="Comma separated list of hosts to run the command on in parallel")
+parser.add_argument("--hosts-file", dest="hosts_file", default=None, help="File with one host per line to run the command on in parallel")
+parser.add_argument("--parallel", type=int, default=10, help="Maximum number of ssh sessions running at once with --hosts/--hosts-file")
+parser.add_argument("--control-master", dest="control_master", action="store_true", help="Multiplex repeated connections to the same host with ControlMaster")
+parser.add_argument("--agent", action="store_true", help="Run as a resident agent that caches the network state for other invocations")
+parser.add_argument("--profile", action="store_true", help="Print how long each startup phase took to stderr")
+parser.add_argument("--profile-file", dest="profile_file", default=None, help="Append the startup phase timings to this file as JSON lines")
+parser.add_argument("--check-deps", dest="check_deps", action="store_true", help="Ignore the cached dependency stamp and probe dpkg again")
 
 args, ssh_args = parser.parse_known_args()
 
-# Check if a string is a valid routable IP
-def is_global_ip(ip_str):
+# Startup phase timings in milliseconds, in the order they happened
+profile_phases = {}
+profile_phases["imports"] = (time.monotonic() - profile_start) * 1000
+
+# Time a startup phase, used as a context manager around each step in main()
+@contextlib.contextmanager
+def profile_phase(name):
+
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        profile_phases[name] = profile_phases.get(name, 0) + (time.monotonic() - start) * 1000
+
+# Report the phase timings if asked to, this has to happen before ssh is started as exec mode never comes back
+def profile_report():
 
     global args
 
+    if not args.profile and not args.profile_file:
+        return
+
+    total = (time.monotonic() - profile_start) * 1000
+
+    if args.profile:
+        for name, ms in profile_phases.items():
+            print(f"{name:<12} {ms:9.3f} ms", file=sys.stderr)
+        print(f"{'total':<12} {total:9.3f} ms", file=sys.stderr)
+
+    if args.profile_file:
+        try:
+            with open(args.profile_file, "a") as f:
+                f.write(json.dumps({"time": time.time(), "pid": os.getpid(), "argv": sys.argv[1:], "phases": profile_phases, "total": total}) + "\n")
+        except OSError as e:
+            print(f"Failed to write profile to {args.profile_file}: {e.strerror}", file=sys.stderr)
+
+# Packages needed by this script, checked once and then cached in a stamp file until dpkg's database changes
+packages = ["python3-dnspython", "python3-pexpect"]
+
+dpkg_status = "/var/lib/dpkg/status"
+
+# Where to keep cached state between runs
+def get_cache_dir():
+
+    cache_dir = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "ssh.py")
+    os.makedirs(cache_dir, exist_ok=True)
+
+    return cache_dir
+
+# Ask dpkg for the installed versions of all packages in a single call
+def get_package_versions():
+
+    result = subprocess.run(["dpkg-query", "-W", "-f=${Package} ${Version} ${db:Status-Status}\\n"] + packages, capture_output=True, text=True)
+
+    versions = {}
+    for line in result.stdout.splitlines():
+        fields = line.split()
+        if len(fields) == 3 and fields[2] == "installed":
+            versions[fields[0]] = fields[1]
+
+    return versions
+
+# Check if all nessecary packages are installed and install the missing ones, the result is stored in a stamp keyed by
+# the package versions and the mtime of dpkg's status file so the common case is a single stat() call
+def check_dependencies(force=False):
+
+    try:
+        status_mtime = os.stat(dpkg_status).st_mtime_ns
+    except OSError:
+        status_mtime = 0
+
+    stamp_file = None
+    try:
+        stamp_file = os.path.join(get_cache_dir(), "deps.stamp")
+        if not force:
+            with open(stamp_file) as f:
+                stamp = json.load(f)
+
+            if stamp.get("mtime") == status_mtime and sorted(stamp.get("versions", {})) == sorted(packages):
+                return
+    except (OSError, ValueError):
+        pass
+
+    try:
+        versions = get_package_versions()
+        missing = [pkg for pkg in packages if pkg not in versions]
+        if missing:
+            subprocess.run(["apt", "-y", "install"] + missing, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            versions = get_package_versions()
+            status_mtime = os.stat(dpkg_status).st_mtime_ns
+    except Exception as e:
+        sys.exit(f"Exception: {str(e)}")
+
+    # Only record a stamp once everything is present so the next run tries again otherwise
+    if stamp_file and all(pkg in versions for pkg in packages):
+        try:
+            tmp_file = f"{stamp_file}.{os.getpid()}"
+            with open(tmp_file, "w") as f:
+                json.dump({"mtime": status_mtime, "versions": versions}, f)
+            os.replace(tmp_file, stamp_file)
+        except OSError:
+            pass
+
+# Site specific prefixes, one "prefix category" pair per line where category is lan or wan, for example
+#   2001:db8:1234::/48   lan
+#   10.99.0.0/16         wan
+# The longest matching prefix wins. Unless the file has a "seed off" line the prefixes of the local addresses and
+# routes are added as lan first, routes shorter than prefix_seed_min_len are left out so a VPN that takes over the
+# whole address space doesn't turn everything into lan. Anything that doesn't match falls back to ipaddress.is_global
+prefixes_file = os.path.join(os.environ.get("XDG_CONFIG_HOME") or os.path.expanduser("~/.config"), "ssh.py", "prefixes.conf")
+prefix_seed_min_len = {4: 8, 6: 16}
+
+# Compiled prefix table, per IP version a dict of prefix length to {network as an int: category}
+prefix_table = None
+
+# Results of classify_address() so each address is only looked at once
+address_categories = {}
+
+def add_prefix(table, network, category):
+
+    table[network.version].setdefault(network.prefixlen, {})[int(network.network_address)] = category
+
+# Build the longest prefix match table from the local interfaces and prefixes_file
+def get_prefix_table():
+
+    global prefix_table
+
+    if prefix_table is not None:
+        return prefix_table
+
+    table = {4: {}, 6: {}}
+    seed = True
+    entries = []
+
+    try:
+        with open(prefixes_file) as f:
+            for line in f:
+                fields = line.split("#", 1)[0].split()
+                if not fields:
+                    continue
+
+                if fields == ["seed", "off"]:
+                    seed = False
+                    continue
+
+                try:
+                    if len(fields) != 2 or fields[1] not in ("lan", "wan"):
+                        raise ValueError
+                    entries.append((ipaddress.ip_network(fields[0], strict=False), fields[1]))
+                except ValueError:
+                    print(f"Ignoring invalid line in {prefixes_file}: {line.strip()}", file=sys.stderr)
+    except OSError:
+        pass
+
+    if seed:
+        try:
+            state = get_netlink_state()
+
+            for addr in state.addresses:
+                if addr.scope == RT_SCOPE_UNIVERSE:
+                    add_prefix(table, ipaddress.ip_interface(f"{addr.address}/{addr.prefixlen}").network, "lan")
+
+            for family, dst, dst_len, ifname in state.routes:
+                network = ipaddress.ip_network(f"{dst}/{dst_len}")
+                if dst_len >= prefix_seed_min_len[network.version]:
+                    add_prefix(table, network, "lan")
+        except Exception:
+            pass
+
+    # The config file is applied last so it overrides seeded prefixes of the same length
+    for network, category in entries:
+        add_prefix(table, network, category)
+
+    # Longest prefixes first so the first hit is the best match
+    prefix_table = {version: sorted(lengths.items(), reverse=True) for version, lengths in table.items()}
+
+    return prefix_table
+
+# Classify an address as lan or wan, returns the category and the IP version or "none" if it isn't an IP at all
+def classify_address(ip_str):
+
+    if ip_str in address_categories:
+        return address_categories[ip_str]
+
     try:
         ip = ipaddress.ip_address(ip_str)
     except ValueError:
+        address_categories[ip_str] = ("none", None)
+        return address_categories[ip_str]
+
+    value = int(ip)
+    bits = ip.max_prefixlen
+    category = None
+
+    for prefixlen, networks in get_prefix_table()[ip.version]:
+        category = networks.get(value >> (bits - prefixlen) << (bits - prefixlen))
+        if category:
+            break
+
+    if category is None:
+        category = "wan" if ip.is_global else "lan"
+
+    address_categories[ip_str] = (category, ip.version)
+
+    return address_categories[ip_str]
+
+# Check if a string is a valid routable IP
+def is_global_ip(ip_str):
+
+    global args
+
+    category, version = classify_address(ip_str)
+
+    if category == "none":
         return "none"
 
-    if not ip.is_global:
+    if category == "lan":
         return "lan"
 
-    if isinstance(ip, ipaddress.IPv6Address):
+    if version == 6:
         # Force IPv6 or default behaviour when only v6 is allowed
         if not args.ipv4:
             return "wanv6"
 
-    if isinstance(ip, ipaddress.IPv4Address):
+    if version == 4:
         # Force IPv4 or default behaviour when only v4 is allowed
         if not args.ipv6:
             return "wanv4"
 
     return "none"
 
-# Find the default interface
-def get_default_nic():
+# rtnetlink constants, see linux/netlink.h, linux/rtnetlink.h, linux/if_link.h and linux/if_addr.h
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x01
+NLM_F_DUMP = 0x300
+RTM_NEWLINK = 16
+RTM_GETLINK = 18
+RTM_NEWADDR = 20
+RTM_GETADDR = 22
+RTM_NEWROUTE = 24
+RTM_GETROUTE = 26
+IFLA_IFNAME = 3
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFA_CACHEINFO = 6
+IFA_FLAGS = 8
+IFA_F_TEMPORARY = 0x01
+IFA_F_DADFAILED = 0x08
+IFA_F_DEPRECATED = 0x20
+IFA_F_TENTATIVE = 0x40
+IFA_F_MANAGETEMPADDR = 0x100
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+RTMGRP_IPV6_IFADDR = 0x100
+RTMGRP_IPV6_ROUTE = 0x400
+RTA_DST = 1
+RTA_OIF = 4
+RTA_PRIORITY = 6
+RTA_TABLE = 15
+RT_TABLE_MAIN = 254
+RT_SCOPE_UNIVERSE = 0
+RTN_UNICAST = 1
+IFF_UP = 0x1
+INFINITY_LIFE_TIME = 0xFFFFFFFF
+
+# An address as reported by the kernel, lifetimes are in seconds with INFINITY_LIFE_TIME meaning forever
+NetlinkAddress = collections.namedtuple("NetlinkAddress", ["ifname", "family", "address", "prefixlen", "scope", "flags", "preferred", "valid"])
+
+# Everything the wrapper needs to know about the local network, from a single netlink socket
+NetlinkState = collections.namedtuple("NetlinkState", ["default_nic", "links", "addresses", "routes"])
+
+netlink_state = None
+
+# How long the wrapper waits on the agent before discovering things itself, and how old the agent's state may get
+agent_timeout = 0.2
+agent_max_age = 60
+
+# Split a buffer of rtattrs into a dict of type to payload
+def parse_rtattrs(data, offset):
+
+    attrs = {}
+    while offset + 4 <= len(data):
+        rta_len, rta_type = struct.unpack_from("=HH", data, offset)
+        if rta_len < 4:
+            break
 
-    gws = netifaces.gateways()
+        attrs[rta_type & 0x3FFF] = data[offset + 4:offset + rta_len]
+        offset += (rta_len + 3) & ~3
 
-    default_gateway = gws.get('default', {})
+    return attrs
 
-    if netifaces.AF_INET in default_gateway:
-        return default_gateway[netifaces.AF_INET][1]
-    elif netifaces.AF_INET6 in default_gateway:
-        return default_gateway[netifaces.AF_INET6][1]
+# Send a dump request and yield (type, payload) for every message in the reply
+def netlink_dump(sock, msg_type, payload, seq):
 
-    return "none"
+    sock.send(struct.pack("=LHHLL", 16 + len(payload), msg_type, NLM_F_REQUEST | NLM_F_DUMP, seq, 0) + payload)
+
+    while True:
+        data = sock.recv(65536)
+        offset = 0
+
+        while offset + 16 <= len(data):
+            msg_len, msg_type, flags, msg_seq, pid = struct.unpack_from("=LHHLL", data, offset)
+            if msg_len < 16:
+                return
+
+            if msg_seq == seq:
+                if msg_type == NLMSG_DONE:
+                    return
+
+                if msg_type == NLMSG_ERROR:
+                    error = struct.unpack_from("=i", data, offset + 16)[0]
+                    if error:
+                        raise OSError(-error, os.strerror(-error))
+                    return
+
+                yield msg_type, data[offset + 16:offset + msg_len]
+
+            offset += (msg_len + 3) & ~3
+
+# Query links, addresses and routes over rtnetlink in one go instead of running ip, netifaces and psutil separately
+def query_netlink():
+
+    links = {}
+    addresses = []
+    routes = []
+    default_routes = []
+
+    with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE) as sock:
+        sock.bind((0, 0))
+
+        for msg_type, msg in netlink_dump(sock, RTM_GETLINK, struct.pack("=BxHiII", socket.AF_UNSPEC, 0, 0, 0, 0), 1):
+            if msg_type != RTM_NEWLINK:
+                continue
+
+            family, if_type, index, if_flags, change = struct.unpack_from("=BxHiII", msg)
+            attrs = parse_rtattrs(msg, 16)
+            if IFLA_IFNAME in attrs:
+                links[index] = {"name": attrs[IFLA_IFNAME].rstrip(b"\0").decode(), "up": bool(if_flags & IFF_UP)}
+
+        for msg_type, msg in netlink_dump(sock, RTM_GETADDR, struct.pack("=BBBBI", socket.AF_UNSPEC, 0, 0, 0, 0), 2):
+            if msg_type != RTM_NEWADDR:
+                continue
+
+            family, prefixlen, flags, scope, index = struct.unpack_from("=BBBBI", msg)
+            attrs = parse_rtattrs(msg, 8)
+
+            raw = attrs.get(IFA_LOCAL, attrs.get(IFA_ADDRESS))
+            if raw is None or index not in links:
+                continue
+
+            # IFA_FLAGS carries the full 32 bit flags, the header only has room for the lower 8
+            if IFA_FLAGS in attrs:
+                flags = struct.unpack("=I", attrs[IFA_FLAGS][:4])[0]
+
+            preferred = valid = INFINITY_LIFE_TIME
+            if IFA_CACHEINFO in attrs:
+                preferred, valid = struct.unpack("=II", attrs[IFA_CACHEINFO][:8])
+
+            addresses.append(NetlinkAddress(links[index]["name"], family, socket.inet_ntop(family, raw), prefixlen, scope, flags, preferred, valid))
+
+        for msg_type, msg in netlink_dump(sock, RTM_GETROUTE, struct.pack("=BBBBBBBBI", socket.AF_UNSPEC, 0, 0, 0, 0, 0, 0, 0, 0), 3):
+            if msg_type != RTM_NEWROUTE:
+                continue
+
+            family, dst_len, src_len, tos, table, protocol, scope, rt_type, flags = struct.unpack_from("=BBBBBBBBI", msg)
+            attrs = parse_rtattrs(msg, 12)
+
+            if RTA_TABLE in attrs:
+                table = struct.unpack("=I", attrs[RTA_TABLE][:4])[0]
+
+            if table != RT_TABLE_MAIN or rt_type != RTN_UNICAST or RTA_OIF not in attrs:
+                continue
+
+            index = struct.unpack("=i", attrs[RTA_OIF][:4])[0]
+            priority = struct.unpack("=I", attrs[RTA_PRIORITY][:4])[0] if RTA_PRIORITY in attrs else 0
+
+            if index not in links:
+                continue
+
+            if dst_len == 0:
+                # IPv4 default routes win over IPv6 ones, same as netifaces did
+                default_routes.append((family != socket.AF_INET, priority, links[index]["name"]))
+            elif RTA_DST in attrs:
+                routes.append((family, socket.inet_ntop(family, attrs[RTA_DST]), dst_len, links[index]["name"]))
+
+    default_nic = min(default_routes)[2] if default_routes else "none"
 
-# Find the stable privacy IP of dev
+    return NetlinkState(default_nic, {link["name"]: link["up"] for link in links.values()}, addresses, routes)
+
+# Where the agent listens, $XDG_RUNTIME_DIR is private to the user so nothing else can answer in its place
+def get_agent_socket():
+
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if not runtime_dir:
+        runtime_dir = get_cache_dir()
+
+    return os.path.join(runtime_dir, "ssh.py.sock")
+
+# Ask a running agent for its copy of the network state, returns None if there isn't one
+def query_agent():
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(agent_timeout)
+            sock.connect(get_agent_socket())
+
+            data = b""
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+
+        state = json.loads(data)
+        return NetlinkState(state["default_nic"], state["links"], [NetlinkAddress(*addr) for addr in state["addresses"]], state["routes"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+# Get the network state from the agent if it's running, otherwise straight from the kernel
+def get_netlink_state():
+
+    global netlink_state
+
+    if netlink_state is None:
+        netlink_state = query_agent()
+
+        if netlink_state is None:
+            netlink_state = query_netlink()
+        elif debug > 0:
+            print("Network state supplied by the agent", file=sys.stderr)
+
+    return netlink_state
+
+# Long running agent that keeps the network state in memory and hands it out over a Unix socket, the state is refreshed
+# whenever the kernel announces a link, address or route change and also every agent_max_age seconds so the
+# address lifetimes handed out stay accurate
+def run_agent():
+
+    import selectors
+
+    events = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+    events.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE | RTMGRP_IPV6_IFADDR | RTMGRP_IPV6_ROUTE))
+    events.setblocking(False)
+
+    sock_path = get_agent_socket()
+    try:
+        os.unlink(sock_path)
+    except FileNotFoundError:
+        pass
+
+    old_umask = os.umask(0o077)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(sock_path)
+    os.umask(old_umask)
+    listener.listen(16)
+
+    sel = selectors.DefaultSelector()
+    sel.register(events, selectors.EVENT_READ)
+    sel.register(listener, selectors.EVENT_READ)
+
+    signal.signal(signal.SIGTERM, lambda sig, frame: sys.exit(0))
+
+    reply = None
+    updated = 0
+
+    try:
+        while True:
+            for key, mask in sel.select():
+                if key.fileobj is events:
+                    # Drain everything queued, one re-query covers any number of changes. ENOBUFS means events were
+                    # lost when the queue overflowed, which the re-query covers just the same
+                    try:
+                        while events.recv(65536):
+                            pass
+                    except OSError:
+                        pass
+
+                    reply = None
+
+                    if debug > 0:
+                        print("Network change detected, refreshing state", file=sys.stderr)
+                    continue
+
+                conn, _ = listener.accept()
+                with conn:
+                    # If the kernel can't be asked right now the client is left to find out for itself
+                    try:
+                        if reply is None or time.monotonic() - updated > agent_max_age:
+                            reply = None
+                            reply = json.dumps(query_netlink()._asdict()).encode()
+                            updated = time.monotonic()
+
+                        conn.sendall(reply)
+                    except OSError:
+                        pass
+    finally:
+        try:
+            os.unlink(sock_path)
+        except OSError:
+            pass
+
+# Find the default interface
+def get_default_nic():
+
+    return get_netlink_state().default_nic
+
+# Find the stable privacy IP of dev, skipping temporary, deprecated and not yet usable addresses and preferring
+# the one that will stay preferred the longest
 def get_stable_ipv6(dev):
 
     global parser
 
-    try:
-        result = subprocess.run(["ip", "-6", "addr", "show", "dev", dev, "scope", "global", "mngtmpaddr"], capture_output=True, text=True, check=True)
+    candidates = []
 
-        for line in result.stdout.strip().splitlines():
-            if line:
-                line = line.strip()
+    try:
+        for addr in get_netlink_state().addresses:
+            if addr.ifname != dev or addr.family != socket.AF_INET6 or addr.scope != RT_SCOPE_UNIVERSE:
+                continue
 
-            if not line:
+            if not addr.flags & IFA_F_MANAGETEMPADDR:
                 continue
 
-            match = re.search(r"^\s*inet6\s+([0-9a-fA-F:]+)/\d+", line)
-            if not match:
+            if addr.flags & (IFA_F_TEMPORARY | IFA_F_DEPRECATED | IFA_F_TENTATIVE | IFA_F_DADFAILED) or addr.preferred == 0:
                 continue
 
-            stableIP = match.group(1)
-            if is_global_ip(stableIP) == "wanv6":
-                return stableIP
+            # Our own prefix may well be lan as far as is_global_ip() is concerned, what matters here is the address itself
+            if ipaddress.ip_address(addr.address).is_global:
+                candidates.append((addr.preferred, addr.address))
     except Exception:
         pass
 
+    if candidates:
+        return max(candidates)[1]
+
     parser.error(f"Failed to find a stable privacy IP on dev {dev}")
 
-# Get IPs for a given hostname, which can then be tested to find out if they are on the LAN or not
-def resolve_host(hostname):
+# DNS answers are cached on disk between runs, negative answers are kept for this long unless the SOA says otherwise
+# and expired answers are still used for up to dns_stale_ttl seconds while a background process refreshes them
+dns_negative_ttl = 60
+dns_stale_ttl = 86400
+dns_resolution_delay = 0.05
 
-    global args
+dns_cache = None
+dns_resolver = None
+dns_stale = set()
+
+# Open (and create if needed) the sqlite DNS cache, it also holds the connect times used by --race
+def get_dns_cache():
+
+    global dns_cache
+
+    if dns_cache is None:
+        import sqlite3
+
+        dns_cache = sqlite3.connect(os.path.join(get_cache_dir(), "dns.sqlite"), timeout=1, isolation_level=None)
+        dns_cache.execute("PRAGMA journal_mode=WAL")
+        dns_cache.execute("PRAGMA synchronous=NORMAL")
+        dns_cache.execute("CREATE TABLE IF NOT EXISTS dns (name TEXT NOT NULL, rdtype TEXT NOT NULL, status TEXT NOT NULL, data TEXT NOT NULL, expires REAL NOT NULL, PRIMARY KEY (name, rdtype))")
+        dns_cache.execute("CREATE TABLE IF NOT EXISTS rtt (address TEXT NOT NULL, port INTEGER NOT NULL, rtt REAL, failures INTEGER NOT NULL, updated REAL NOT NULL, PRIMARY KEY (address, port))")
+
+    return dns_cache
+
+def get_dns_resolver():
+
+    global dns_resolver
+
+    if dns_resolver is None:
+        import dns.asyncresolver
+
+        dns_resolver = dns.asyncresolver.Resolver()
+        dns_resolver.timeout = 2
+        dns_resolver.lifetime = 5
+
+        # Point the resolver somewhere else, ip or ip:port, which is how the benchmark uses its stub DNS server
+        nameserver = os.environ.get("SSH_PY_NAMESERVER")
+        if nameserver:
+            address, _, port = nameserver.rpartition(":") if nameserver.count(":") == 1 else (nameserver, "", "")
+            dns_resolver.nameservers = [address]
+            if port:
+                dns_resolver.port = int(port)
+
+    return dns_resolver
+
+# Work out how long a negative answer may be cached for from the SOA in the authority section
+def negative_ttl(responses):
+
+    import dns.rdatatype
+
+    for response in responses:
+        for rrset in response.authority:
+            if rrset.rdtype == dns.rdatatype.SOA:
+                return min(rrset.ttl, rrset[0].minimum)
+
+    return dns_negative_ttl
 
-    res = dns.resolver.Resolver()
-    res.timeout = 2
-    res.lifetime = 5
+def store_dns(name, rdtype, status, data, ttl):
+
+    try:
+        get_dns_cache().execute("INSERT OR REPLACE INTO dns (name, rdtype, status, data, expires) VALUES (?, ?, ?, ?, ?)", (name, rdtype, status, json.dumps(data), time.time() + ttl))
+    except Exception:
+        pass
+
+# Query the network for a single record type, returns status ("ok", "noanswer", "nxdomain" or "timeout") and a list of values
+async def query_dns(name, rdtype):
+
+    import dns.exception
+    import dns.rdatatype
+    import dns.resolver
+
+    try:
+        answers = await get_dns_resolver().resolve(name, rdtype)
+    except dns.resolver.NXDOMAIN as e:
+        store_dns(name, rdtype, "nxdomain", [], negative_ttl(e.responses().values()))
+        return "nxdomain", []
+    except dns.resolver.NoAnswer as e:
+        store_dns(name, rdtype, "noanswer", [], negative_ttl([e.response()]))
+        return "noanswer", []
+    except (dns.resolver.NoNameservers, dns.exception.Timeout):
+        return "timeout", []
+
+    if answers.rdtype == dns.rdatatype.CNAME:
+        values = [str(rdata.target).rstrip(".") for rdata in answers]
+    else:
+        values = [rdata.address for rdata in answers]
+
+    # The expiration covers the whole CNAME chain, so the final target is cached under both names
+    ttl = max(answers.expiration - time.time(), 0)
+    store_dns(name, rdtype, "ok", values, ttl)
+
+    canonical = str(answers.canonical_name).rstrip(".")
+    if canonical != name.rstrip("."):
+        store_dns(canonical, rdtype, "ok", values, ttl)
+
+    return "ok", values
+
+# Look up a record in the cache, returns None if there is no usable entry. lookup_dns() goes to the network if needed
+def cached_dns(name, rdtype):
+
+    try:
+        row = get_dns_cache().execute("SELECT status, data, expires FROM dns WHERE name=? AND rdtype=?", (name, rdtype)).fetchone()
+    except Exception:
+        row = None
+
+    if row:
+        status, data, expires = row
+        now = time.time()
+
+        if now < expires:
+            return status, json.loads(data)
+
+        if now < expires + dns_stale_ttl:
+            dns_stale.add((name, rdtype))
+            return status, json.loads(data)
+
+    return None
+
+async def lookup_dns(name, rdtype):
+
+    cached = cached_dns(name, rdtype)
+    if cached is not None:
+        return cached
+
+    return await query_dns(name, rdtype)
+
+# Refresh expired cache entries in a detached process so the connection isn't held up waiting for them
+def refresh_stale_dns():
+
+    global dns_cache
+
+    if not dns_stale:
+        return
+
+    stale = list(dns_stale)
+    dns_stale.clear()
+
+    try:
+        pid = os.fork()
+    except OSError:
+        return
+
+    if pid:
+        os.waitpid(pid, 0)
+        return
+
+    # Double fork so the refresh outlives us without leaving a zombie behind
+    try:
+        if os.fork() == 0:
+            import asyncio
+
+            async def refresh():
+                await asyncio.gather(*[query_dns(name, rdtype) for name, rdtype in stale])
+
+            dns_cache = None
+            asyncio.run(refresh())
+    except Exception:
+        pass
+
+    os._exit(0)
+
+# Get IPs for a given hostname, which can then be tested to find out if they are on the LAN or not.
+# AAAA, A and CNAME queries are all sent at once and the answer is picked in that order of preference as soon as every
+# more preferred query has finished, when A answers first AAAA is only given dns_resolution_delay to catch up (RFC 8305)
+async def resolve_host_async(hostname, ipv4, ipv6):
+
+    import asyncio
 
     tried = set()
 
-    def try_resolve(name):
+    async def follow_cname(name):
+        status, values = await lookup_dns(name, "CNAME")
+        for target in values:
+            if debug > 0:
+                print(f"Received the following answers: {target}", file=sys.stderr)
+
+            ret = await try_resolve(target)
+            if ret != "none":
+                return "ok", ret
+
+        return status, []
+
+    async def try_resolve(name):
         if name in tried:
             return "none"
 
         if debug > 0:
-            print(f"Starting check for {name}...")
+            print(f"Starting check for {name}...", file=sys.stderr)
 
         tried.add(name)
 
+        order = [rdtype for rdtype, skip in (("AAAA", ipv4), ("A", ipv6)) if not skip]
+        tasks = {rdtype: asyncio.ensure_future(lookup_dns(name, rdtype)) for rdtype in order}
+        tasks["CNAME"] = asyncio.ensure_future(follow_cname(name))
+        order.append("CNAME")
+
+        deadline = None
+
         try:
-            if not args.ipv4:
-                answers = res.resolve(name, dns.rdatatype.AAAA)
-                if debug > 0:
-                    for rdata in answers:
-                        print(f"Received the following answers: {rdata}")
-                return [rdata.address for rdata in answers]
-        except (dns.resolver.NoAnswer, dns.exception.Timeout):
-            pass
-        except dns.resolver.NXDOMAIN:
+            while order:
+                for rdtype in order:
+                    if not tasks[rdtype].done():
+                        break
+
+                    status, values = tasks[rdtype].result()
+                    if status == "nxdomain":
+                        return "none"
+
+                    if values:
+                        if debug > 0:
+                            for value in values:
+                                print(f"Received the following answers: {value}", file=sys.stderr)
+                        return values
+                else:
+                    return "none"
+
+                # A less preferred answer is already in, only give the pending ones a short grace period
+                if deadline is None and any(tasks[rdtype].done() and tasks[rdtype].result()[1] for rdtype in order):
+                    deadline = time.monotonic() + dns_resolution_delay
+
+                timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+                pending = [task for task in tasks.values() if not task.done()]
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    order = [rdtype for rdtype in order if tasks[rdtype].done()]
+        finally:
+            for task in tasks.values():
+                task.cancel()
+
+        return "none"
+
+    return await try_resolve(hostname)
+
+# Answers already worked out during this run, keyed by hostname and the -4/-6 flags in effect
+resolved_hosts = {}
+
+# Same order of preference as resolve_host_async() but only using the cache, so a warm cache doesn't even need
+# asyncio or dnspython loaded. Returns None if anything it needs isn't cached
+def resolve_host_cached(hostname, ipv4, ipv6, tried=None):
+
+    if tried is None:
+        tried = set()
+
+    if hostname in tried:
+        return "none"
+
+    tried.add(hostname)
+
+    for rdtype, skip in (("AAAA", ipv4), ("A", ipv6)):
+        if skip:
+            continue
+
+        cached = cached_dns(hostname, rdtype)
+        if cached is None:
+            return None
+
+        status, values = cached
+        if status == "nxdomain":
             return "none"
 
-        try:
-            if not args.ipv6:
-                answers = res.resolve(name, dns.rdatatype.A)
+        if values:
+            return values
+
+    cached = cached_dns(hostname, "CNAME")
+    if cached is None:
+        return None
+
+    for target in cached[1]:
+        ret = resolve_host_cached(target, ipv4, ipv6, tried)
+        if ret != "none":
+            return ret
+
+    return "none"
+
+def resolve_host(hostname):
+
+    global args
+
+    key = (hostname, args.ipv4, args.ipv6)
+    if key not in resolved_hosts:
+        ret = resolve_host_cached(*key)
+
+        if ret is None:
+            import asyncio
+
+            ret = asyncio.run(resolve_host_async(*key))
+
+        resolved_hosts[key] = ret
+        refresh_stale_dns()
+
+    return resolved_hosts[key]
+
+# Resolve many (hostname, ipv4, ipv6) keys at once so later resolve_host() calls for them return straight away
+def prefetch_hosts(keys):
+
+    import asyncio
+
+    keys = [key for key in dict.fromkeys(keys) if key not in resolved_hosts]
+    if not keys:
+        return
+
+    async def prefetch():
+        return await asyncio.gather(*[resolve_host_async(*key) for key in keys])
+
+    resolved_hosts.update(zip(keys, asyncio.run(prefetch())))
+    refresh_stale_dns()
+
+# --race starts a new connection attempt this often until one succeeds (RFC 8305) and gives up after race_timeout,
+# an address that failed within rtt_failure_ttl seconds is tried last
+race_attempt_delay = 0.25
+race_timeout = 5
+rtt_failure_ttl = 600
+
+# Sort addresses so the one that connected fastest last time comes first and recently failed ones come last
+def order_by_rtt(addresses, port):
+
+    known = {}
+    try:
+        for address, rtt, failures, updated in get_dns_cache().execute("SELECT address, rtt, failures, updated FROM rtt WHERE port=?", (port,)):
+            known[address] = (rtt, failures, updated)
+    except Exception:
+        pass
+
+    now = time.time()
+
+    def sort_key(item):
+        index, address = item
+        rtt, failures, updated = known.get(address, (None, 0, 0))
+        return (failures > 0 and now - updated < rtt_failure_ttl, race_timeout if rtt is None else rtt, index)
+
+    return [address for index, address in sorted(enumerate(addresses), key=sort_key)]
+
+# Remember how a connection attempt went, the RTT is smoothed so one slow connect doesn't reorder everything
+def record_rtt(address, port, rtt):
+
+    try:
+        cache = get_dns_cache()
+        if rtt is None:
+            cache.execute("INSERT INTO rtt (address, port, rtt, failures, updated) VALUES (?, ?, NULL, 1, ?) ON CONFLICT (address, port) DO UPDATE SET failures = failures + 1, updated = excluded.updated", (address, port, time.time()))
+        else:
+            cache.execute("INSERT INTO rtt (address, port, rtt, failures, updated) VALUES (?, ?, ?, 0, ?) ON CONFLICT (address, port) DO UPDATE SET rtt = COALESCE(0.7 * rtt + 0.3 * excluded.rtt, excluded.rtt), failures = 0, updated = excluded.updated", (address, port, rtt, time.time()))
+    except Exception:
+        pass
+
+# Race TCP connects to addresses in order, starting the next one every race_attempt_delay or as soon as one fails, and
+# return the first address to connect. IPv6 attempts are bound to source when given so the result matches what ssh
+# will see once it's bound to the stable IP
+async def race_connect(addresses, port, source=None):
+
+    import asyncio
+
+    async def attempt(address):
+        start = time.monotonic()
+        local_addr = (source, 0) if source and ":" in address else None
+        reader, writer = await asyncio.open_connection(address, port, local_addr=local_addr)
+        writer.close()
+        return time.monotonic() - start
+
+    queue = list(addresses)
+    pending = set()
+    attempts = {}
+    deadline = time.monotonic() + race_timeout
+
+    try:
+        while queue or pending:
+            if queue:
+                address = queue.pop(0)
+                task = asyncio.ensure_future(attempt(address))
+                attempts[task] = address
+                pending.add(task)
+
+            timeout = race_attempt_delay if queue else deadline - time.monotonic()
+            if timeout <= 0:
+                break
+
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            for task in done:
+                if task.exception() is None:
+                    record_rtt(attempts[task], port, task.result())
+                    if debug > 0:
+                        print(f"Connected to {attempts[task]} in {task.result() * 1000:.1f} ms", file=sys.stderr)
+                    return attempts[task]
+
+                record_rtt(attempts[task], port, None)
                 if debug > 0:
-                    for rdata in answers:
-                        print(f"Received the following answers: {rdata}")
-                return [rdata.address for rdata in answers]
-        except (dns.resolver.NoAnswer, dns.exception.Timeout):
-            pass
-        except dns.resolver.NXDOMAIN:
-            return "none"
+                    print(f"Failed to connect to {attempts[task]}: {task.exception()}", file=sys.stderr)
+    finally:
+        for task in pending:
+            task.cancel()
+
+    return None
+
+# ssh_config files read in the same order as ssh, the first value found for a keyword wins
+ssh_config_files = [os.path.expanduser("~/.ssh/config"), "/etc/ssh/ssh_config"]
 
+# The only keywords the wrapper cares about, everything else is left for ssh to deal with
+ssh_config_keywords = {"hostname", "port", "addressfamily", "proxyjump", "proxycommand", "hostkeyalias"}
+
+# The host being connected to, the settings from ssh_config that apply to it and its addresses that classify_target()
+# picked
+target_host = None
+target_config = {}
+target_addresses = []
+
+def get_mtime(path):
+
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+# Parse one ssh_config file into entries of (host patterns, settings), following Include directives relative to base_dir. Match blocks
+# aren't evaluated, anything under one is skipped. Every file and Include directory looked at is added to seen so
+# the index can be invalidated when any of them change
+def parse_ssh_config(path, patterns, entries, seen, base_dir, depth=0):
+
+    import glob
+    import shlex
+
+    seen[path] = get_mtime(path)
+    if depth > 16 or seen[path] is None:
+        return
+
+    try:
+        with open(path, errors="replace") as f:
+            lines = f.readlines()
+    except OSError:
+        return
+
+    settings = {}
+    entries.append((patterns, settings))
+
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+
+        match = re.match(r"^(\S+?)(?:\s*=\s*|\s+)(.*)$", line)
+        if not match:
+            continue
+
+        keyword = match.group(1).lower()
         try:
-            answers = res.resolve(name, dns.rdatatype.CNAME)
-            for rdata in answers:
-                if debug > 0:
-                    print(f"Received the following answers: {rdata}")
-                return try_resolve(str(rdata.target).rstrip("."))
-        except (dns.resolver.NoAnswer, dns.exception.Timeout):
-            return "none"
+            values = shlex.split(match.group(2), comments=True)
+        except ValueError:
+            continue
 
-        return "none"
+        if keyword == "host":
+            patterns = [value.lower() for value in values]
+            settings = {}
+            entries.append((patterns, settings))
+        elif keyword == "match":
+            patterns = None
+            settings = {}
+        elif keyword == "include":
+            for value in values:
+                value = os.path.expanduser(value)
+                if not os.path.isabs(value):
+                    value = os.path.join(base_dir, value)
+
+                seen[os.path.dirname(value)] = get_mtime(os.path.dirname(value))
+                for include in sorted(glob.glob(value)):
+                    parse_ssh_config(include, patterns, entries, seen, base_dir, depth + 1)
+
+            # Lines after the Include still belong to the block it was in
+            settings = {}
+            entries.append((patterns, settings))
+        elif patterns is not None and keyword in ssh_config_keywords and values and keyword not in settings:
+            settings[keyword] = " ".join(values)
+
+# Load the compiled ssh_config index from the cache, rebuilding it if any file it was built from has changed
+def get_ssh_config_index():
+
+    cache_file = os.path.join(get_cache_dir(), "ssh_config.json")
 
-    return try_resolve(hostname)
+    try:
+        with open(cache_file) as f:
+            index = json.load(f)
+
+        if all(get_mtime(path) == mtime for path, mtime in index["files"].items()):
+            return index["entries"]
+    except (OSError, ValueError, KeyError, AttributeError):
+        pass
+
+    entries = []
+    seen = {}
+    for path in ssh_config_files:
+        parse_ssh_config(path, ["*"], entries, seen, os.path.dirname(path))
+
+    entries = [(patterns, settings) for patterns, settings in entries if patterns is not None and settings]
+
+    try:
+        tmp_file = f"{cache_file}.{os.getpid()}"
+        with open(tmp_file, "w") as f:
+            json.dump({"files": seen, "entries": entries}, f)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        pass
+
+    return entries
+
+# ssh style pattern matching, * and ? wildcards and ! to negate
+def ssh_host_matches(host, patterns):
+
+    import fnmatch
+
+    matched = False
+    for pattern in patterns:
+        negate = pattern.startswith("!")
+        if negate:
+            pattern = pattern[1:]
+
+        if fnmatch.fnmatchcase(host, pattern.replace("[", "[[]")):
+            if negate:
+                return False
+            matched = True
+
+    return matched
+
+# Work out what ssh would use for HostName, Port, AddressFamily and ProxyJump/ProxyCommand for alias
+def lookup_ssh_config(alias):
+
+    found = {}
+
+    for patterns, settings in get_ssh_config_index():
+        if not ssh_host_matches(alias.lower(), patterns):
+            continue
+
+        for keyword, value in settings.items():
+            found.setdefault(keyword, value)
+
+    if "hostname" in found:
+        found["hostname"] = found["hostname"].replace("%h", alias).replace("%%", "%")
+
+    return found
 
 # Check to see if ip_host is a hostname or IP
 def check_ip_host(ip_host):
@@ -187,15 +1158,98 @@ def check_ip_host(ip_host):
 
     return "ip", None
 
+# Split the host out of a [user@]host argument
+def get_target(arg):
+
+    # split only on the FIRST '@' (some usernames contain @)
+    if "@" in arg:
+        _, arg = arg.split("@", 1)
+
+    return arg
+
+# Look target up in ssh_config, returning the config along with the real hostname and -4/-6 flags to resolve it with
+def get_target_config(target):
+
+    global args
+
+    config = lookup_ssh_config(target)
+    host = config.get("hostname", target)
+
+    ipv4, ipv6 = args.ipv4, args.ipv6
+
+    address_family = config.get("addressfamily", "any").lower()
+    if address_family == "inet" and not ipv6:
+        ipv4 = True
+    elif address_family == "inet6" and not ipv4:
+        ipv6 = True
+
+    return config, host, ipv4, ipv6
+
+def uses_proxy(config):
+
+    return config.get("proxyjump", "none").lower() != "none" or config.get("proxycommand", "none").lower() != "none"
+
+# Check if target is on the LAN or not, returns none, lan, wanv4 or wanv6 along with its ssh_config settings and every
+# address of the target in that category, or proxy if ssh_config sends the connection through a ProxyJump or
+# ProxyCommand as the source address doesn't matter then
+def classify_target(target):
+
+    global args
+
+    config, host, ipv4, ipv6 = get_target_config(target)
+
+    if uses_proxy(config):
+        return "proxy", config, []
+
+    if debug > 0:
+        print(f" → Using hostname/IP: {host}", file=sys.stderr)
+
+    saved = args.ipv4, args.ipv6
+    args.ipv4, args.ipv6 = ipv4, ipv6
+
+    is_lan = "none"
+    addresses = []
+
+    try:
+        ip_host, dns_records = check_ip_host(host)
+
+        if debug > 0:
+            print(f"ip_host: {ip_host}...", file=sys.stderr)
+
+        if ip_host == "ip":
+            dns_records = [host]
+        elif ip_host != "host":
+            dns_records = []
+
+        for ip in dns_records:
+            if debug > 0:
+                print(f"ip: {ip}...", file=sys.stderr)
+
+            ret = is_global_ip(ip)
+            if debug > 0:
+                print(f"ret: {ret}...", file=sys.stderr)
+
+            if is_lan == "none":
+                if ret == "lan" or (not args.ipv4 and ret == "wanv6") or (not args.ipv6 and ret == "wanv4"):
+                    is_lan = ret
+
+            if ret == is_lan:
+                addresses.append(ip)
+    finally:
+        args.ipv4, args.ipv6 = saved
+
+    return is_lan, config, addresses
+
 # Loop through commandline arguments to find hostnames and IPs
 def check_host_or_ip():
     """
     Iterate over ssh_args, find first host/IP, check if LAN or global,
     and return:
-        is_lan        : none, lan, wanv4 or wanv6 depending if any hostname resolves only to LAN IPs or IPv4 IPs
+        is_lan        : none, lan, wanv4 or wanv6 depending if any hostname resolves only to LAN IPs or IPv4 IPs,
+                        or proxy if ssh_config sends the connection through a ProxyJump or ProxyCommand
     """
 
-    global args, ssh_args
+    global args, ssh_args, target_config, target_addresses, target_host
 
     is_lan = "none"
 
@@ -207,60 +1261,166 @@ def check_host_or_ip():
             continue
 
         if debug > 0:
-            print(f"Checking {arg}...")
+            print(f"Checking {arg}...", file=sys.stderr)
 
         # Skip options
         if arg.startswith("-"):
             continue
 
-        # If argument contains user@host, extract the host part
-        if "@" in arg:
-            # split only on the FIRST '@' (some usernames contain @)
-            _, host_part = arg.split("@", 1)
-            target = host_part
-        else:
-            target = arg
+        target_host = get_target(arg)
+        is_lan, target_config, target_addresses = classify_target(target_host)
+        if is_lan != "none":
+            break
 
-        if debug > 0:
-            print(f" → Using hostname/IP: {target}")
+    return is_lan
 
-        ip_host, dns_records = check_ip_host(target)
+# Read the hosts for fan-out mode from --hosts and --hosts-file, skipping blank lines, comments and duplicates
+def get_fanout_hosts():
 
-        if debug > 0:
-            print(f"ip_host: {ip_host}...")
+    global args, parser
 
-        if ip_host == "ip":
-            ret = is_global_ip(target)
-            if ret == "lan":
-                is_lan = ret
-                break
-            if not args.ipv4 and ret == "wanv6":
-                is_lan = ret
+    hosts = []
+
+    if args.hosts:
+        hosts += [host.strip() for host in args.hosts.split(",")]
+
+    if args.hosts_file:
+        try:
+            with open(args.hosts_file) as f:
+                hosts += [line.split("#", 1)[0].strip() for line in f]
+        except OSError as e:
+            parser.error(f"Error: Can't read {args.hosts_file}: {e.strerror}")
+
+    return list(dict.fromkeys(host for host in hosts if host))
+
+# Run one ssh session and copy its output a line at a time with the host in front, returns the exit status
+async def run_fanout_host(host, ssh_cmd, semaphore):
+
+    import asyncio
+
+    # Read in chunks and split the lines here, the stream's own line reading gives up on lines over 64 KiB
+    async def relay(stream, out):
+        prefix = f"{host}: ".encode()
+        pending = b""
+
+        while True:
+            chunk = await stream.read(65536)
+            if not chunk:
                 break
-            if not args.ipv6 and ret == "wanv4":
-                is_lan = ret
+
+            *lines, pending = (pending + chunk).split(b"\n")
+            if lines:
+                out.write(b"".join(prefix + line + b"\n" for line in lines))
+                out.flush()
+
+        if pending:
+            out.write(prefix + pending + b"\n")
+            out.flush()
+
+    async with semaphore:
+        if debug > 0:
+            print([ssh_binary] + ssh_cmd, file=sys.stderr)
+
+        proc = await asyncio.create_subprocess_exec(ssh_binary, *ssh_cmd, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        await asyncio.gather(relay(proc.stdout, sys.stdout.buffer), relay(proc.stderr, sys.stderr.buffer))
+
+        return await proc.wait()
+
+# ssh options that take an argument, either attached (-oBatchMode=yes) or as the next word (-o BatchMode=yes)
+ssh_arg_options = "BbcDEeFIiJLlmOoPpQRSWw"
+
+# Split the ssh options at the front of ssh_args from the remote command in fan-out mode, where there's no hostname
+# between them to tell where one ends and the other starts. A "--" ends the options
+def split_fanout_args(fanout_args):
+
+    options = []
+    i = 0
+
+    while i < len(fanout_args):
+        arg = fanout_args[i]
+
+        if arg == "--":
+            i += 1
+            break
+
+        if not arg.startswith("-") or arg == "-":
+            break
+
+        options.append(arg)
+        i += 1
+
+        # Walk the bundled flags (-tv) until one that takes an argument, which is the rest of the word or the next one
+        for pos, flag in enumerate(arg[1:], 2):
+            if flag in ssh_arg_options:
+                if pos == len(arg) and i < len(fanout_args):
+                    options.append(fanout_args[i])
+                    i += 1
                 break
 
-        if ip_host == "host":
-            for ip in dns_records:
-                if debug > 0:
-                    print(f"ip: {ip}...")
+    return options, fanout_args[i:]
 
-                ret = is_global_ip(ip)
-                if debug > 0:
-                    print(f"ret: {ret}...")
+# Run ssh_args as a command on every host given with --hosts/--hosts-file. All the hosts are resolved at once, the
+# stable IP is only looked up once and up to --parallel sessions run at the same time
+def run_fanout(dev):
 
-                if ret == "lan":
-                    is_lan = ret
-                    break
-                if not args.ipv4 and ret == "wanv6":
-                    is_lan = ret
-                    break
-                if not args.ipv6 and ret == "wanv4":
-                    is_lan = ret
-                    break
+    global args, parser, ssh_args
 
-    return is_lan
+    import asyncio
+
+    hosts = get_fanout_hosts()
+    if not hosts:
+        parser.error("Error: No hosts given with --hosts or --hosts-file.")
+
+    # Options go before the host, otherwise ssh would take them as part of the remote command
+    options, command = split_fanout_args(ssh_args)
+    if not command:
+        parser.error("Error: You must provide a command to run with --hosts or --hosts-file.")
+
+    targets = {host: get_target_config(get_target(host)) for host in hosts}
+    prefetch_hosts((target_host, ipv4, ipv6) for config, target_host, ipv4, ipv6 in targets.values() if not uses_proxy(config) and is_global_ip(target_host) == "none")
+
+    common_cmd = []
+
+    if args.ipv4:
+        common_cmd += ["-4"]
+    elif args.ipv6:
+        common_cmd += ["-6"]
+
+    if args.port:
+        common_cmd += ["-p", args.port]
+
+    if args.control_master:
+        common_cmd += ["-o", "ControlMaster=auto", "-o", f"ControlPath={get_cache_dir()}/cm-%C", "-o", "ControlPersist=60"]
+
+    stable_ip = None
+    commands = {}
+
+    for host in hosts:
+        is_lan, config, addresses = classify_target(get_target(host))
+        if is_lan == "none":
+            print(f"{host}: Error: Failed to resolve host", file=sys.stderr)
+            continue
+
+        ssh_cmd = list(common_cmd)
+
+        if is_lan == "wanv6" and dev is not None:
+            if stable_ip is None:
+                stable_ip = get_stable_ipv6(dev)
+            ssh_cmd += ["-B", dev, "-b", stable_ip]
+
+        commands[host] = ssh_cmd + options + [host] + command
+
+    async def fanout():
+        semaphore = asyncio.Semaphore(max(args.parallel, 1))
+        return await asyncio.gather(*[run_fanout_host(host, ssh_cmd, semaphore) for host, ssh_cmd in commands.items()])
+
+    failed = len(hosts) - len(commands)
+    for host, status in zip(commands, asyncio.run(fanout())):
+        if status != 0:
+            print(f"{host}: Exited with status {status}", file=sys.stderr)
+            failed += 1
+
+    return 1 if failed else 0
 
 def set_winsize():
     """Set window size of child pty to match the current terminal."""
@@ -270,8 +1430,12 @@ def set_winsize():
     if child is None:
         return
 
-    rows, cols = os.popen('stty size', 'r').read().split()
-    child.setwinsize(int(rows), int(cols))
+    try:
+        size = os.get_terminal_size(sys.stdin.fileno())
+    except OSError:
+        return
+
+    child.setwinsize(size.lines, size.columns)
 
 def sigwinch_passthrough(sig, data):
     set_winsize()
@@ -279,37 +1443,56 @@ def sigwinch_passthrough(sig, data):
 def main():
     global parser, args, ssh_args, child
 
+    if args.agent:
+        run_agent()
+        return
+
+    with profile_phase("deps"):
+        check_dependencies(args.check_deps)
+
     if args.ipv4 and args.ipv6:
         parser.error("Error: You cannot use -4 and -6 at the same time.")
 
-    # Check that there is at least one argument, presumably a hostname or IP
+    # Check that there is at least one argument, presumably a hostname or IP, or the command in fan-out mode
+    fanout = args.hosts or args.hosts_file
     if not ssh_args:
+        if fanout:
+            parser.error("Error: You must provide a command to run with --hosts or --hosts-file.")
         parser.error("Error: You must provide a hostname or IP for ssh.")
 
-    # Check for a submitted network interface, otherwise get the default network interface
-    dev = args.interface
-    if not dev:
-        dev = get_default_nic()
+    # Check for a submitted network interface, otherwise get the default network interface. If the kernel can't be
+    # asked (no netlink in a container or sandbox) ssh still runs, just without binding to the stable IP
+    with profile_phase("network"):
+        try:
+            dev = args.interface
+            if not dev:
+                dev = get_default_nic()
 
-    if dev not in netifaces.interfaces():
-        parser.error("Error: {dev} isn't a valid interface.")
+            links = get_netlink_state().links
+        except OSError as e:
+            print(f"Warning: Failed to read the network state, not binding to a stable IP: {e}", file=sys.stderr)
+            dev = None
 
-    iface_stat = False
-    for iface, stats in psutil.net_if_stats().items():
-        if iface == dev and stats.isup:
-            iface_stat = True
-            break
+    if dev is not None:
+        if dev not in links:
+            parser.error(f"Error: {dev} isn't a valid interface.")
 
-    if not iface_stat:
-        parser.error("Error: {dev} isn't up.")
+        if not links[dev]:
+            parser.error(f"Error: {dev} isn't up.")
+
+    if fanout:
+        profile_report()
+        sys.exit(run_fanout(dev))
 
     # Send all ssh args to find the hostname or IP to connect to
-    is_lan = check_host_or_ip()
+    with profile_phase("resolve"):
+        is_lan = check_host_or_ip()
+
     if is_lan == "none":
         parser.error("Error: You must provide a hostname or IP for ssh.")
 
-    # Start building the ssh commandline arguments
-    ssh_cmd = ["-tt"]
+    # Start building the ssh commandline arguments, when ssh is exec'd it can work out for itself if a tty is needed
+    ssh_cmd = [] if args.exec_ssh else ["-tt"]
 
     if args.ipv4:
         ssh_cmd += ["-4"]
@@ -319,22 +1502,63 @@ def main():
     if args.port:
         ssh_cmd += ["-p", args.port]
 
-    ssh_cmd += ssh_args
-
     # If connecting to a server via IPv6 that isn't on the LAN bind to the network interface and IP
-    if is_lan == "wanv6":
-        stable_ip = get_stable_ipv6(dev)
+    stable_ip = None
+    if is_lan == "wanv6" and dev is not None:
+        with profile_phase("stable_ip"):
+            stable_ip = get_stable_ipv6(dev)
         ssh_cmd += ["-B", dev]
         ssh_cmd += ["-b", stable_ip]
 
+    # Hand ssh the address that answered first, the host key is still checked against the hostname
+    if args.race and len(target_addresses) > 1:
+        import asyncio
+
+        port = int(args.port or target_config.get("port", 22))
+
+        with profile_phase("race"):
+            address = asyncio.run(race_connect(order_by_rtt(target_addresses, port), port, stable_ip))
+
+        if address:
+            ssh_cmd += ["-o", f"HostName={address}"]
+            # ssh only looks up [host]:port itself when there's no alias, so it has to be spelled out for other ports
+            if "hostkeyalias" not in target_config:
+                alias = target_config.get("hostname", target_host)
+                if port != 22:
+                    alias = f"[{alias}]:{port}"
+                ssh_cmd += ["-o", f"HostKeyAlias={alias}"]
+
+    # Our own options go before the user's as anything after the hostname may be the remote command
+    ssh_cmd += ssh_args
+
     if debug > 0:
-        print(["/usr/bin/ssh"] + ssh_cmd)
+        print([ssh_binary] + ssh_cmd, file=sys.stderr)
 
-    # Everything should be good to connect now
-    child = pexpect.spawn("/usr/bin/ssh", args=ssh_cmd)
+    # Everything should be good to connect now, in exec mode ssh takes over this process so the wrapper costs nothing
+    # for the rest of the session
+    if args.exec_ssh:
+        profile_report()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.execv(ssh_binary, [ssh_binary] + ssh_cmd)
+
+    with profile_phase("spawn"):
+        import pexpect
+
+        child = pexpect.spawn(ssh_binary, args=ssh_cmd)
+
+    profile_report()
     set_winsize()
     signal.signal(signal.SIGWINCH, sigwinch_passthrough)
     child.interact()
 
+    # interact() returns as soon as ssh has exited, whatever ssh wrote just before that is still waiting in the pty
+    while not child.isalive():
+        try:
+            data = child.read_nonblocking(65536, timeout=0.1)
+        except (pexpect.EOF, pexpect.TIMEOUT):
+            break
+        os.write(sys.stdout.fileno(), data)
+
 if __name__ == "__main__":
     main()